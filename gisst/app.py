@@ -9,11 +9,14 @@ import datetime
 import fnmatch
 import shutil
 from collections import OrderedDict
+from multiprocessing import cpu_count
 from flask import Flask, Blueprint, redirect, request, url_for, Response
 from flask import render_template, send_file, jsonify
+from flask.json import JSONEncoder
 from PIL import Image
 from database import DatabaseManager as dbm
 from database import (
+    Record,
     LOCAL_GAME_DATA_STORE,
     LOCAL_DATA_ROOT,
     LOCAL_CITATION_DATA_STORE
@@ -25,6 +28,18 @@ from schema import (
     PERF_SCHEMA_VERSION,
     generate_cite_ref
 )
+from search_service import search_display
+from render import (
+    render_gif,
+    render_clip,
+    render_batch,
+    get_gif_params,
+    get_clip_params,
+    check_render,
+    derivative_cache,
+    RenderError
+)
+from render_queue import RenderJobQueue, JOB_DONE
 from extractors import (
     save_byte_array_to_store,
     save_file_to_store,
@@ -32,14 +47,28 @@ from extractors import (
 )
 
 
+#   Database records are not dicts, serialize them as their field mapping
+class RecordJSONEncoder(JSONEncoder):
+
+    def default(self, o):
+        if isinstance(o, Record):
+            return o._asdict()
+        return JSONEncoder.default(self, o)
+
 
 app = Flask(__name__)
+app.json_encoder = RecordJSONEncoder
 local_cite_data_path = LOCAL_CITATION_DATA_STORE
 local_game_data_path = LOCAL_GAME_DATA_STORE
 cite_data_source = Blueprint('cite_data_source', __name__, static_url_path='/cite_data', static_folder=local_cite_data_path)
 game_data_source = Blueprint('game_data_source', __name__, static_url_path='/game_data', static_folder=local_game_data_path)
 app.register_blueprint(cite_data_source)
 app.register_blueprint(game_data_source)
+#   GIF renders run in the background, at most RENDER_WORKERS at a time
+RENDER_WORKERS = 2
+#   ffmpeg processes per highlight reel, so reels on every worker together stay within the cores
+RENDER_BATCH_PROCS = max(1, cpu_count() // RENDER_WORKERS)
+render_jobs = RenderJobQueue(workers=RENDER_WORKERS)
 
 
 @app.route("/")
@@ -47,6 +76,14 @@ def start_page():
     return "Main page coming soon..."
 
 
+@app.route('/derivatives/<path:file_ref>')
+def derivative(file_ref):
+    path = derivative_cache.get_path(file_ref)
+    if '..' in file_ref or not os.path.isfile(path):
+        return 'Not found', 404
+    return send_file_partial(path)
+
+
 @app.route('/cite_data/<source_hash>/<filename>')
 def cite_data(source_hash, filename):
     return send_file_partial("{}/{}/{}".format(local_cite_data_path, source_hash, filename))
@@ -61,51 +98,34 @@ def game_data(source_hash, filename):
 def search():
     search_string = request.args.get('search_query', '')
     search_type = request.args.get('search_type', '')
+    page = request.args.get('page', 1, type=int)
+    results = dict(games=[], performances=[], states=[], total_records=0, page=1, page_count=0,
+                   total_game_records=0, total_performance_records=0, total_state_records=0)
     if search_string:
-        search_json = json.dumps({'start_index':0, 'description':{'title': search_string}})
-        if not search_type or search_type == 'all':
-            proc_args = ['gisst', '--no_prompts', 'search', search_json]
-        elif search_type == 'game':
-            proc_args = ['gisst', '--no_prompts', 'search', '--game_only', search_json]
-        elif search_type == 'performance':
-            proc_args = ['gisst', '--no_prompts', 'search', '--perf_only', search_json]
-        elif search_type == 'state':
-            proc_args = ['gisst', '--no_prompts', 'search', '--state_only', search_json]
-
-        try:
-            output = subprocess.check_output(proc_args)
-        except subprocess.CalledProcessError as e:
-            print(e.message)
-            print(e.output)
-            game_results = []
-            performance_results =[]
-            state_results =[]
-        else:
-            results = json.loads(output)
-            results['games'] = map(lambda d: dict((i, d[i]) for i in d if i != 'schema_version'), results['games'])
-            results['performances'] = map(lambda d: dict((i, d['performance'][i]) for i in d['performance'] if i != 'schema_version'), results['performances'])
-            game_results = map(lambda x: generate_cite_ref(GAME_CITE_REF, GAME_SCHEMA_VERSION, **x), results['games'])
-            performance_results = map(lambda x: generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, **x), results['performances'])
-            state_results = results['states']
-    else:
-        game_results = []
-        performance_results = []
-        state_results = []
+        #   Results are listed from the display fields stored in the search index
+        results = search_display({'start_index': 0, 'page': page, 'description': {'title': search_string}},
+                                 search_type=search_type)
 
     return render_template('search.html',
-                           game_results=game_results,
-                           performance_results=performance_results,
-                           state_results=state_results,
+                           game_results=results['games'],
+                           performance_results=results['performances'],
+                           state_results=results['states'],
                            source_type=search_type,
                            prev_query=search_string,
-                           total_results=len(game_results) + len(performance_results) + len(state_results))
+                           total_results=results['total_records'],
+                           total_game_results=results['total_game_records'],
+                           total_performance_results=results['total_performance_records'],
+                           total_state_results=results['total_state_records'],
+                           page=results['page'],
+                           page_count=results['page_count'])
 
 @app.route("/citation/<uuid>")
 def citation_page(uuid):
     game_ref = dbm.retrieve_game_ref(uuid)
     perf_ref = dbm.retrieve_perf_ref(uuid)
-    derived_performances = dbm.retrieve_derived_performances(uuid)
-    previous_performances = dbm.retrieve_performance_chain(uuid)[:-1]
+    perf_list_columns = dbm.list_columns[dbm.PERFORMANCE_CITATION_TABLE]
+    derived_performances = dbm.retrieve_derived_performances(uuid, columns=perf_list_columns)
+    previous_performances = dbm.retrieve_performance_chain(uuid, columns=perf_list_columns)[:-1]
     save_states = dbm.retrieve_save_state(game_uuid=uuid)
     extra_files = dbm.retrieve_file_path(game_uuid=uuid)
 
@@ -176,6 +196,7 @@ def emulation_info_game(uuid):
         game_info['stateFileURL'] = None
         game_info['record'] = game_ref.elements
         game_info['availableStates'] = filter(lambda s: True if s.get('save_state_source_data') or s.get('rl_starts_data') else False, dbm.retrieve_save_state(game_uuid=uuid))
+        #   Full records, the player edits these and posts them back on save
         game_info['availablePerformances'] = [dict(p.get_element_items()) for p in dbm.retrieve_derived_performances(uuid)]
     return jsonify(game_info)
 
@@ -186,6 +207,7 @@ def performance_info(uuid):
     perf_ref = dbm.retrieve_perf_ref(uuid)
     perf_info['record'] = perf_ref.elements
     perf_info['linkedStates'] = dbm.retrieve_all_state_perf_links(uuid)
+    #   Full records, see emulation_info_game
     perf_info['availablePerformances'] = [dict(p.get_element_items()) for p in dbm.retrieve_derived_performances(perf_ref['game_uuid'])]
     return jsonify(perf_info)
 
@@ -214,13 +236,14 @@ def compare_page():
     game_uuids = []
     state_uuids = []
     for id in uuids:
-        if dbm.retrieve_attr_from_db('uuid', id, dbm.GAME_CITATION_TABLE):
+        if dbm.is_attr_in_db('uuid', id, dbm.GAME_CITATION_TABLE):
             game_uuids.append(id)
             state_uuids.append('NO_ID')
-        elif dbm.retrieve_attr_from_db('uuid', id, dbm.GAME_SAVE_TABLE):
-            state = dbm.retrieve_save_state(uuid=id)[0]
-            state_uuids.append(id)
-            game_uuids.append(state['game_uuid'])
+        else:
+            state = dbm.retrieve_save_state(columns=('uuid', 'game_uuid'), uuid=id)
+            if state:
+                state_uuids.append(id)
+                game_uuids.append(state[0]['game_uuid'])
 
     return render_template('compare.html',
                            game_uuids=",".join(game_uuids),
@@ -252,28 +275,29 @@ def add_extra_file(uuid):
 
     #   If file with current hash and path already exists, add a new record for save state but
     #   do not create a duplicate file
-    file_id = dbm.check_for_existing_file(rel_file_path, hash_check)
-    if file_id:
-        dbm.link_existing_file_to_save_state(uuid, file_id)
-        print "File {}:{} found.".format(file_name, rel_file_path)
-    else:
-        print "File {}:{} created.".format(file_name, rel_file_path)
-        source_data_hash, file_name = save_byte_array_to_store(extra_b_array,
-                                                               file_name=file_name,
-                                                               store_path=LOCAL_GAME_DATA_STORE)
-        fields = OrderedDict(
-            game_uuid=None,
-            save_state_uuid=uuid,
-            is_executable=is_executable,
-            main_executable=main_executable,
-            file_path=rel_file_path,
-            source_data=source_data_hash
-        )
-        state_ref = dbm.retrieve_save_state(uuid=uuid)[0]
-        fields['game_uuid'] = state_ref['game_uuid']
-        dbm.add_to_file_path_table(**fields)
-
-    file_path = dbm.retrieve_file_path(save_state_uuid=uuid, file_path=rel_file_path)[0]
+    with dbm.transaction():
+        file_id = dbm.check_for_existing_file(rel_file_path, hash_check)
+        if file_id:
+            dbm.link_existing_file_to_save_state(uuid, file_id)
+            print "File {}:{} found.".format(file_name, rel_file_path)
+        else:
+            print "File {}:{} created.".format(file_name, rel_file_path)
+            source_data_hash, file_name = save_byte_array_to_store(extra_b_array,
+                                                                   file_name=file_name,
+                                                                   store_path=LOCAL_GAME_DATA_STORE)
+            fields = OrderedDict(
+                game_uuid=None,
+                save_state_uuid=uuid,
+                is_executable=is_executable,
+                main_executable=main_executable,
+                file_path=rel_file_path,
+                source_data=source_data_hash
+            )
+            state_ref = dbm.retrieve_save_state(uuid=uuid)[0]
+            fields['game_uuid'] = state_ref['game_uuid']
+            dbm.add_to_file_path_table(**fields)
+
+        file_path = dbm.retrieve_file_path(save_state_uuid=uuid, file_path=rel_file_path)[0]
     return jsonify(file_path)
 
 
@@ -295,19 +319,22 @@ def add_save_state(uuid):
         created_on=None,
         created=datetime.datetime.now()
     )
-    state_uuid = dbm.add_to_save_state_table(fts=True, **fields)
-
-    #   Attach performance information if present
-    if performance_uuid:
-        #   Sometimes a state maybe linked to a performance without a specific index?
-        #   Since we are adding a new state, it is always a state save action
-        if performance_time_index:
-            dbm.link_save_state_to_performance(state_uuid, performance_uuid, performance_time_index, 'save')
-        else:
-            dbm.link_save_state_to_performance(state_uuid, performance_uuid, 0, 'save')
-
-    #   Retrieve save state information to get uuid and ignore blank fields
-    save_state = dbm.retrieve_save_state(uuid=state_uuid)[0]
+    with dbm.transaction():
+        state_uuid = dbm.add_to_save_state_table(**fields)
+
+        #   Attach performance information if present
+        if performance_uuid:
+            #   Sometimes a state maybe linked to a performance without a specific index?
+            #   Since we are adding a new state, it is always a state save action
+            if performance_time_index:
+                dbm.link_save_state_to_performance(state_uuid, performance_uuid, performance_time_index, 'save')
+            else:
+                dbm.link_save_state_to_performance(state_uuid, performance_uuid, 0, 'save')
+
+        #   Retrieve save state information to get uuid and ignore blank fields
+        save_state = dbm.retrieve_save_state(uuid=state_uuid)[0]
+    #   Indexed once committed, so a rolled back state never shows up in search
+    dbm.add_to_fts(**dbm.get_state_fts_fields(dict(fields, uuid=state_uuid)))
     return jsonify({'record': save_state})
 
 @app.route("/state/<uuid>/add_screen_data", methods=['POST'])
@@ -340,10 +367,10 @@ def add_save_state_data(uuid):
         save_state_b_array.extend([0 for _ in range(len(save_state_b_array), data_length)])
 
     source_data_hash, file_name = save_byte_array_to_store(save_state_b_array, file_name=uuid)
-    dbm.update_table(dbm.GAME_SAVE_TABLE,
-                     ['save_state_source_data', 'compressed'],
-                     [source_data_hash, compressed],
-                     ['uuid'], [uuid])
+    dbm.wait(dbm.update_table(dbm.GAME_SAVE_TABLE,
+                              ['save_state_source_data', 'compressed'],
+                              [source_data_hash, compressed],
+                              ['uuid'], [uuid]))
     return jsonify({'record': dbm.retrieve_save_state(uuid=uuid)[0]})
 
 @app.route("/state/<uuid>/add_rl_data", methods=['POST'])
@@ -366,10 +393,10 @@ def add_rl_save_state_data(uuid):
     rl_start_hash, file_name = save_byte_array_to_store(rl_starts_b_array, file_name=uuid)
     rl_lengths_hash, file_name = save_byte_array_to_store(rl_lengths_b_array, file_name=uuid)
 
-    dbm.update_table(dbm.GAME_SAVE_TABLE,
-                     ['rl_starts_data','rl_lengths_data','rl_total_length','compressed'],
-                     [rl_start_hash, rl_lengths_hash, rl_total_length, True],
-                     ['uuid'], [uuid])
+    dbm.wait(dbm.update_table(dbm.GAME_SAVE_TABLE,
+                              ['rl_starts_data','rl_lengths_data','rl_total_length','compressed'],
+                              [rl_start_hash, rl_lengths_hash, rl_total_length, True],
+                              ['uuid'], [uuid]))
 
     return jsonify({'record': dbm.retrieve_save_state(uuid=uuid)[0]})
 
@@ -378,43 +405,50 @@ def add_rl_save_state_data(uuid):
 def update_save_state(uuid):
     update_fields = json.loads(request.form.get('update_fields'))
 
-    #   if linking to a performance, do that and then throw away since GAME_SAVE_TABLE doesn't refer to performance
-    if 'performance_uuid' in update_fields:
-        performance_uuid = update_fields['performance_uuid']
-        performance_time_index = update_fields['performance_time_index']
-        action = update_fields['action']
-        dbm.link_save_state_to_performance(uuid, performance_uuid, performance_time_index, action)
-        del update_fields['performance_uuid']
-        del update_fields['performance_time_index']
-        del update_fields['action']
+    with dbm.transaction():
+        #   if linking to a performance, do that and then throw away since GAME_SAVE_TABLE doesn't refer to performance
+        if 'performance_uuid' in update_fields:
+            performance_uuid = update_fields['performance_uuid']
+            performance_time_index = update_fields['performance_time_index']
+            action = update_fields['action']
+            dbm.link_save_state_to_performance(uuid, performance_uuid, performance_time_index, action)
+            del update_fields['performance_uuid']
+            del update_fields['performance_time_index']
+            del update_fields['action']
 
-    #   make sure that there are still fields to update
-    if len(update_fields.keys()) > 0:
-        dbm.update_table(dbm.GAME_SAVE_TABLE, update_fields.keys(),update_fields.values(), ['uuid'], [uuid])
-    return jsonify(dbm.retrieve_save_state(uuid=uuid)[0])
+        #   make sure that there are still fields to update
+        if len(update_fields.keys()) > 0:
+            dbm.update_table(dbm.GAME_SAVE_TABLE, update_fields.keys(),update_fields.values(), ['uuid'], [uuid])
+        save_state = dbm.retrieve_save_state(uuid=uuid)[0]
+    return jsonify(save_state)
 
 
 @app.route("/performance/<uuid>/update", methods=['POST'])
 def performance_update(uuid):
     update_fields = json.loads(request.form.get('update_fields'))
-    dbm.update_table(dbm.PERFORMANCE_CITATION_TABLE, update_fields.keys(), update_fields.values(), ["uuid"], [uuid])
+    dbm.wait(dbm.update_table(dbm.PERFORMANCE_CITATION_TABLE, update_fields.keys(), update_fields.values(), ["uuid"], [uuid]))
+    #   Invalidate again once the write has landed, a reader may have cached the old row in between
+    dbm.cite_cache.invalidate(uuid)
     perf_ref = dbm.retrieve_perf_ref(uuid)
-    #dbm.update_table(dbm.FTS_INDEX_TABLE, ['content'], [perf_ref.to_json_string()],["uuid"], [uuid])
     return perf_ref.to_json_string()
 
 @app.route("/game/<uuid>/update", methods=['POST'])
 def game_update(uuid):
     update_fields = json.loads(request.form.get('update_fields'))
-    dbm.update_table(dbm.GAME_CITATION_TABLE, update_fields.keys(), update_fields.values(), ["uuid"], [uuid])
+    dbm.wait(dbm.update_table(dbm.GAME_CITATION_TABLE, update_fields.keys(), update_fields.values(), ["uuid"], [uuid]))
+    #   Invalidate again once the write has landed, a reader may have cached the old row in between
+    dbm.cite_cache.invalidate(uuid)
     game_ref = dbm.retrieve_game_ref(uuid)
-    #dbm.update_table(dbm.FTS_INDEX_TABLE, ['content'], [game_ref.to_json_string()], ["uuid"], [uuid])
     return game_ref.to_json_string()
 
 @app.route("/performance/<uuid>/add", methods=['POST'])
 def performance_add(uuid):
     record = json.loads(request.form.get('record'))
     perf_ref = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, game_uuid=uuid, **record)
-    dbm.add_to_citation_table(perf_ref, fts=True)
+    #   The row exists on return, so a following save state link finds the performance
+    if dbm.add_to_citation_table(perf_ref, fts=True) is False:
+        #   Already catalogued, hand back the existing performance
+        perf_ref = dbm.retrieve_perf_ref(dbm.get_duplicate_citation_uuid(perf_ref))
     return jsonify({'record': perf_ref.elements})
 
 @app.route("/performance/<uuid>/add_video_data", methods=['POST'])
@@ -472,7 +506,9 @@ def citation_add(cite_type):
         cite = generate_cite_ref(GAME_CITE_REF, GAME_SCHEMA_VERSION, **clean_params)
     elif cite_type == PERF_CITE_REF:
         cite = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, **clean_params)
-    dbm.add_to_citation_table(cite, fts=True)
+    if dbm.add_to_citation_table(cite, fts=True) is False:
+        #   Already catalogued, show the existing citation
+        return redirect(url_for('citation_page', uuid=dbm.get_duplicate_citation_uuid(cite)))
     return redirect(url_for('citation_page', uuid=cite['uuid']))
 
 
@@ -488,34 +524,120 @@ def citation_new(cite_type):
 @app.route("/delete/<uuid>")
 def delete(uuid):
     subprocess.call(["gisst", "delete", uuid])
+    #   The delete ran in another process and may cascade to derived performances
+    dbm.cite_cache.clear()
     return redirect(url_for('citations_all_page'))
 
+@app.route("/json/stats")
+def stats():
+    return jsonify({'cite_cache': dbm.cite_cache.stats(),
+                    'db_writer': dbm.writer.stats() if dbm.writer else None,
+                    'fts_writer': dbm.fts_writer.stats() if dbm.fts_writer else None,
+                    'render_jobs': render_jobs.stats(),
+                    'derivative_cache': derivative_cache.stats()})
+
 @app.route("/citations")
 def citations_all_page():
-    all_game_cites = [dbm.create_cite_ref_from_db(GAME_CITE_REF, x) for x in dbm.retrieve_all_from_table(dbm.GAME_CITATION_TABLE)]
-    all_perf_cites = [dbm.create_cite_ref_from_db(PERF_CITE_REF, x) for x in dbm.retrieve_all_from_table(dbm.PERFORMANCE_CITATION_TABLE)]
+    game_columns = dbm.list_columns[dbm.GAME_CITATION_TABLE]
+    perf_columns = dbm.list_columns[dbm.PERFORMANCE_CITATION_TABLE]
+    all_game_cites = [dbm.create_cite_ref_from_db(GAME_CITE_REF, x, game_columns)
+                      for x in dbm.retrieve_all_from_table(dbm.GAME_CITATION_TABLE, columns=game_columns)]
+    all_perf_cites = [dbm.create_cite_ref_from_db(PERF_CITE_REF, x, perf_columns)
+                      for x in dbm.retrieve_all_from_table(dbm.PERFORMANCE_CITATION_TABLE, columns=perf_columns)]
     return render_template('citations_main.html',
                            all_game_cites=all_game_cites,
                            all_perf_cites=all_perf_cites,
                            perf_headers=all_perf_cites[0].get_element_names() if all_perf_cites else [],
                            game_headers=all_game_cites[0].get_element_names() if all_game_cites else [])
 
+#   Renders of a performance's 'startTime' to 'endTime' range, where 'kind' is gif or clip.
+#   Renders done before are served straight from the derivative cache, others are queued.
+def submit_render(kind, render_function, params_function):
+    start = request.form.get('startTime', type=int)
+    end = request.form.get('endTime', type=int)
+    uuid = request.form['uuid']
+    perf_ref = dbm.retrieve_perf_ref(uuid)
+    if not perf_ref:
+        return jsonify(error='Invalid performance uuid: {}'.format(uuid)), 404
+    if start is None or end is None:
+        return jsonify(error='{} needs a start and an end time.'.format(kind.capitalize())), 400
+    #   Checked here as well as in the render, so a render that can only fail is never queued
+    try:
+        check_render(perf_ref, start, end)
+    except RenderError as e:
+        return jsonify(error=str(e)), 400
+
+    params = params_function(perf_ref, start, end)
+    location = {'{}_location'.format(kind): url_for('derivative', file_ref=derivative_cache.get_file_ref(params))}
+    if derivative_cache.get(params):
+        return jsonify(status=JOB_DONE, **location)
+
+    #   Repeated requests for the same render while it runs get the same job
+    job = render_jobs.submit((kind, uuid, start, end), render_function, perf_ref, start, end)
+    return jsonify(job_id=job.id,
+                   status=job.status,
+                   status_url=url_for('{}_status'.format(kind), job_id=job.id),
+                   **location), 202
+
+def render_status(job_id):
+    job = render_jobs.get(job_id)
+    if not job:
+        return jsonify(error='No render job with id {}'.format(job_id)), 404
+    return jsonify(**job.to_json_dict())
+
 @app.route("/gif", methods=["POST"])
 def gif():
-    start = request.form['startTime']
-    end = request.form['endTime']
-    uuid = request.form['uuid']
-    source_hash = request.form['source_hash']
+    return submit_render('gif', render_gif, get_gif_params)
+
+@app.route("/gif/<job_id>")
+def gif_status(job_id):
+    return render_status(job_id)
 
-    subprocess.call(["gisst", "gif_performance", "--regenerate", uuid, start, end])
+#   MP4 clips are stream copies, so they start at the keyframe at or before 'startTime'
+@app.route("/clip", methods=["POST"])
+def clip():
+    return submit_render('clip', render_clip, get_clip_params)
 
-    location_info = {'gif_location': '/cite_data/{0}/{0}_{1}_{2}.gif'.format(
-        uuid,
-        start,
-        end
-    )}
+@app.route("/clip/<job_id>")
+def clip_status(job_id):
+    return render_status(job_id)
 
-    return jsonify(**location_info)
+#   Gifs or mp4 clips ('format') of several time ranges of one performance, 'ranges' is a json
+#   list of [start, end] pairs in seconds. The job result lists a file per range in order.
+@app.route("/json/highlight_reel", methods=["POST"])
+def highlight_reel():
+    uuid = request.form['uuid']
+    render_format = request.form.get('format', 'gif')
+    try:
+        ranges = [(int(start), int(end)) for start, end in json.loads(request.form['ranges'])]
+    except (KeyError, ValueError, TypeError):
+        return jsonify(error='ranges must be a json list of [start, end] pairs.'), 400
+    perf_ref = dbm.retrieve_perf_ref(uuid)
+    if not perf_ref:
+        return jsonify(error='Invalid performance uuid: {}'.format(uuid)), 404
+    if render_format not in ('gif', 'mp4'):
+        return jsonify(error='Unknown render format: {}'.format(render_format)), 400
+    if not ranges:
+        return jsonify(error='ranges must be a json list of [start, end] pairs.'), 400
+    try:
+        for start, end in ranges:
+            check_render(perf_ref, start, end)
+    except RenderError as e:
+        return jsonify(error=str(e)), 400
+
+    params_function = get_gif_params if render_format == 'gif' else get_clip_params
+    locations = [url_for('derivative', file_ref=derivative_cache.get_file_ref(params_function(perf_ref, start, end)))
+                 for start, end in ranges]
+    job = render_jobs.submit(('reel', uuid, render_format, tuple(ranges)), render_batch, perf_ref, ranges,
+                             format=render_format, procs=RENDER_BATCH_PROCS)
+    return jsonify(job_id=job.id,
+                   status=job.status,
+                   status_url=url_for('highlight_reel_status', job_id=job.id),
+                   locations=locations), 202
+
+@app.route("/json/highlight_reel/<job_id>")
+def highlight_reel_status(job_id):
+    return render_status(job_id)
 
 if __name__ == '__main__':
     app.run()
@@ -1,6 +1,7 @@
 __author__ = 'erickaltman'
 
 import os
+import re
 import json
 import pytz
 import click
@@ -8,24 +9,28 @@ import uuid
 import sqlite3
 import platform
 import sys
+import atexit
+import threading
 from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, scoped_session
-from sqlalchemy.exc import ResourceClosedError
-from whoosh.fields import Schema, STORED, ID, KEYWORD, TEXT
+from sqlalchemy.exc import ResourceClosedError, IntegrityError
+from whoosh.fields import ID, KEYWORD, TEXT, NUMERIC
 from whoosh.query import *
-from whoosh.qparser import QueryParser
-from whoosh.index import create_in, open_dir
-from whoosh.writing import AsyncWriter
+from whoosh import sorting
+from whoosh.index import create_in
 from datetime import datetime
 from functools import partial
+from contextlib import contextmanager
 from collections import OrderedDict
-from itertools import chain
+from itertools import chain, izip
 from schema import (
     GAME_CITE_REF,
     PERF_CITE_REF,
     generate_cite_ref
 )
-from utils import bound_array
+from write_queue import WriteQueue, WriteFuture
+from fts_index import FTSIndexManager, FTSWriteQueue, build_index, versioned_schema, get_schema_version
+from utils import LRUCache
 
 #   This is needed for managing db connections in SQLite because Flask runs each
 #   session as a thread local
@@ -44,10 +49,35 @@ else:
     print "This is not running on a supported system. Goodbye!"
     sys.exit(1)
 
+#   Connection time SQLite pragmas, WAL lets readers proceed while the threaded server writes.
+#   Each can be overridden per deployment with an environment variable, e.g. GISST_SQLITE_MMAP_SIZE=0
+SQLITE_PRAGMAS = OrderedDict([
+    ('journal_mode',    'WAL'),
+    ('busy_timeout',    '5000'),        # milliseconds
+    ('synchronous',     'NORMAL'),
+    ('cache_size',      '-16000'),      # negative values are KiB
+    ('mmap_size',       '268435456')    # bytes
+])
+for pragma in SQLITE_PRAGMAS:
+    SQLITE_PRAGMAS[pragma] = os.environ.get('GISST_SQLITE_{}'.format(pragma.upper()), SQLITE_PRAGMAS[pragma])
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        #   Pragmas do not accept bound parameters, so only allow plain values through
+        if not re.match(r'^-?\w+$', str(value)):
+            raise ValueError('Invalid value for SQLite pragma {}: {}'.format(pragma, value))
+        cursor.execute('pragma {} = {}'.format(pragma, value))
+    cursor.close()
+
+event.listen(engine, 'connect', set_sqlite_pragmas)
+
 DB_FILE_NAME = os.path.join(LOCAL_DATA_ROOT, 'cite.db')
 LOCAL_CITATION_DATA_STORE = os.path.join(LOCAL_DATA_ROOT, 'cite_data')
 LOCAL_GAME_DATA_STORE = os.path.join(LOCAL_DATA_ROOT, 'game_data')
 LOCAL_FTS_INDEX = os.path.join(LOCAL_DATA_ROOT, 'fts_index')
+LOCAL_DERIVATIVE_CACHE = os.path.join(LOCAL_DATA_ROOT, 'derivative_cache')
 
 
 #   Database utility functions, might move somewhere else if there are too many
@@ -66,6 +96,86 @@ def field_constraint(field, constraint):
 def no_constraint(field, constraint):
     return "{}".format(field)
 
+
+#   Compact row records, one slotted class per table (and projection) instead of an OrderedDict
+#   per row. They support the read only dict interface that templates and callers rely on, plus
+#   item assignment for existing fields. JSON encoding goes through _asdict().
+class Record(object):
+    __slots__ = ()
+    _fields = ()
+    _field_set = frozenset()
+
+    def __init__(self, values):
+        for field, value in izip(self._fields, values):
+            setattr(self, field, value)
+
+    def __getitem__(self, key):
+        if key in self._field_set:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._field_set:
+            setattr(self, key, value)
+        else:
+            raise KeyError('{} not found in record fields.'.format(key))
+
+    def __contains__(self, key):
+        return key in self._field_set
+
+    def __iter__(self):
+        return iter(self._fields)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        return isinstance(other, Record) and self.items() == other.items()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, ", ".join(['{}={!r}'.format(f, v) for f, v in self.items()]))
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self._field_set else default
+
+    def keys(self):
+        return list(self._fields)
+
+    def values(self):
+        return [getattr(self, f) for f in self._fields]
+
+    def items(self):
+        return [(f, getattr(self, f)) for f in self._fields]
+
+    def _asdict(self):
+        return OrderedDict(self.items())
+
+
+def record_type(name, fields):
+    fields = tuple(fields)
+    return type(str(name), (Record,), {'__slots__': fields, '_fields': fields, '_field_set': frozenset(fields)})
+
+
+#   Four digit year in a free text date, for the numeric year field of the search index
+def get_year(date_text):
+    match = re.search(r'\b(\d{4})\b', unicode(date_text)) if date_text else None
+    return int(match.group(1)) if match else None
+
+
+#   Values of nested dicts and lists joined as plain text, so keys and punctuation stay out of the index
+def get_plain_text(value):
+    def values(v):
+        if isinstance(v, dict):
+            return chain.from_iterable(values(x) for x in v.values())
+        if isinstance(v, list):
+            return chain.from_iterable(values(x) for x in v)
+        return [unicode(v)] if v is not None else []
+    return u" ".join(values(value))
+
+
 class DatabaseManager:
     db = scoped_session(sessionmaker(bind=engine))
     current_db_file = DB_FILE_NAME
@@ -85,6 +195,18 @@ class DatabaseManager:
 
     _constraints = []
 
+    #   Per thread state, matches the thread local scoped session above
+    _local = threading.local()
+
+    #   WriteQueue when single writer mode is on, see start_writer
+    writer = None
+
+    #   Hydrated CiteRefs by uuid for retrieve_game_ref / retrieve_perf_ref, only found citations
+    #   are cached so citations added by other processes show up straight away. Edits and deletes
+    #   made by another process, e.g. a gisst command run from the web app, aren't seen until the
+    #   cache is cleared, callers that start one clear it afterwards.
+    cite_cache = LRUCache(max_size=1024)
+
     fields = {
         EXTRACTED_TABLE: [
             ('id',                  'integer primary key',  field_constraint),
@@ -114,7 +236,8 @@ class DatabaseManager:
             ('source_data',         'text',                 field_constraint),
             ('schema_version',      'text',                 field_constraint),
             ('created',             'datetime',             field_constraint),
-            ('cite_object',         'text',                 field_constraint)
+            ('cite_object',         'text',                 field_constraint),
+            ('content_hash',        'text',                 field_constraint)   #   See CiteRef.get_content_hash
         ],
         GAME_FILE_PATH_TABLE: [
             ('id',                  'integer primary key',  field_constraint),
@@ -171,7 +294,8 @@ class DatabaseManager:
             ('additional_info',                     'text',                 field_constraint),
             ('schema_version',                      'text',                 field_constraint),
             ('created',                             'datetime',             field_constraint),
-            ('cite_object',                         'text',                 field_constraint)
+            ('cite_object',                         'text',                 field_constraint),
+            ('content_hash',                        'text',                 field_constraint)   #   See CiteRef.get_content_hash
         ],
         SAVE_STATE_PERFORMANCE_LINK_TABLE: [
             ('performance_uuid', 'text', field_constraint),
@@ -195,6 +319,40 @@ class DatabaseManager:
         ]
     }
 
+    #   Secondary indexes, 3-tuples of form (index_name, (col_name, ...), is_unique), created by the
+    #   schema migrations below so that existing cite.db files pick them up as well
+    indexes = {
+        GAME_CITATION_TABLE: [
+            ('game_citation_uuid_idx',                  ('uuid',),                              False),
+            ('game_citation_content_hash_idx',          ('content_hash',),                      True)
+        ],
+        PERFORMANCE_CITATION_TABLE: [
+            ('performance_citation_uuid_idx',           ('uuid',),                              False),
+            ('performance_citation_game_uuid_idx',      ('game_uuid',),                         False),
+            ('performance_citation_previous_idx',       ('previous_performance_uuid',),         False),
+            ('performance_citation_content_hash_idx',   ('content_hash',),                      True)
+        ],
+        GAME_SAVE_TABLE: [
+            ('game_save_uuid_idx',                      ('uuid',),                              False),
+            ('game_save_game_uuid_idx',                 ('game_uuid',),                         False)
+        ],
+        GAME_FILE_PATH_TABLE: [
+            ('game_file_path_game_uuid_idx',            ('game_uuid',),                         False),
+            ('game_file_path_save_state_uuid_idx',      ('save_state_uuid',),                   False)
+        ],
+        SAVE_STATE_PERFORMANCE_LINK_TABLE: [
+            ('state_perf_link_performance_uuid_idx',    ('performance_uuid', 'time_index'),     False),
+            ('state_perf_link_save_state_uuid_idx',     ('save_state_uuid',),                   False)
+        ]
+    }
+
+    #   Schema migrations, 3-tuples of form (version, description, method_name), applied in order
+    #   to any database whose 'PRAGMA user_version' is lower than the migration's version
+    migrations = [
+        (1, 'Add secondary indexes for uuid lookup columns', '_migrate_create_indexes'),
+        (2, 'Add citation content hashes for duplicate detection', '_migrate_add_content_hash')
+    ]
+
     headers = {
         EXTRACTED_TABLE: ('id', 'title', 'source_uri', 'extracted_datetime', 'source_file_hash', 'metadata'),
         GAME_CITATION_TABLE: [x for x, _, _ in fields[GAME_CITATION_TABLE]],
@@ -206,8 +364,54 @@ class DatabaseManager:
         GIF_LINK_TABLE: [x for x, _, _ in fields[GIF_LINK_TABLE]]
     }
 
+    #   Slim projections for listing and existence style callers, these leave out the redundant
+    #   cite_object copy and the large recorded data columns. Citation projections keep 'uuid' and
+    #   'schema_version' since create_cite_ref_from_db needs both. Records the player's info table
+    #   edits and posts back are sent in full, a projected one would save its missing fields as null.
+    large_columns = {
+        GAME_CITATION_TABLE: ('source_data', 'notes', 'cite_object'),
+        PERFORMANCE_CITATION_TABLE: ('inputs', 'input_events', 'data_events', 'cite_object')
+    }
+
+    list_columns = {
+        GAME_CITATION_TABLE: [x for x in headers[GAME_CITATION_TABLE] if x not in large_columns[GAME_CITATION_TABLE]],
+        PERFORMANCE_CITATION_TABLE: [x for x in headers[PERFORMANCE_CITATION_TABLE]
+                                     if x not in large_columns[PERFORMANCE_CITATION_TABLE]]
+    }
+
+    #   Record classes by (table_name, columns), see get_record_type
+    _record_types = {}
+
     #   Full Text Search setup
-    fts_schema = Schema(title=TEXT(stored=True), content=TEXT, id=ID(stored=True), source_hash=ID(stored=True), tags=KEYWORD(stored=True))
+    #   Full text search schema, bump FTS_SCHEMA_VERSION on any change and the index is rebuilt
+    #   from the database by create_tables. Citation elements with their own field are boosted,
+    #   the text of the remaining elements goes to 'content'. Display fields are stored so search
+    #   results can be shown without reading the database.
+    FTS_SCHEMA_VERSION = 3
+    fts_schema = versioned_schema(FTS_SCHEMA_VERSION,
+                                  id=ID(stored=True, unique=True),
+                                  tags=KEYWORD(stored=True),
+                                  source_hash=ID(stored=True),
+                                  game_uuid=ID(stored=True),
+                                  title=TEXT(stored=True, field_boost=4.0),
+                                  platform=TEXT(stored=True, field_boost=2.0, sortable=True),
+                                  developer=TEXT(field_boost=1.5),
+                                  publisher=TEXT(field_boost=1.5),
+                                  performer=TEXT(stored=True, field_boost=2.0),
+                                  description=TEXT(stored=True, field_boost=1.5),
+                                  year=NUMERIC(stored=True),
+                                  content=TEXT)
+    fts_search_fields = ('title', 'platform', 'developer', 'publisher', 'performer', 'description', 'content')
+    #   Counted by search_fts_page, platform is sortable so it's counted by whole value rather than by word
+    fts_facet_fields = ('tags', 'platform', 'year')
+    #   Citation elements left out of 'content', ids and recorded data that only add noise
+    fts_excluded_elements = ('uuid', 'game_uuid', 'previous_performance_uuid', 'schema_version', 'copyright_year',
+                             'inputs', 'input_events', 'data_events', 'emulator_system_configuration',
+                             'additional_info', 'source_data', 'source_url', 'data_image_checksum')
+    fts_index = FTSIndexManager(LOCAL_FTS_INDEX, fts_schema)
+    fts_writer = None
+    fts_tables = (GAME_CITATION_TABLE, PERFORMANCE_CITATION_TABLE, GAME_SAVE_TABLE)
+    _fts_writer_lock = threading.Lock()
 
     @classmethod
     def delete_db(cls):
@@ -242,97 +446,441 @@ class DatabaseManager:
                 click.echo("Table '{}' not found, creating...".format(table))
                 cls.create_table(table, cls.fields[table])
 
+        #   Bring older databases up to the current schema version
+        cls.migrate_db()
+
         #   Create FTS_index
         if not os.path.exists(LOCAL_FTS_INDEX):
             click.echo("Full text search index not found, creating...")
             os.mkdir(LOCAL_FTS_INDEX)
             create_in(LOCAL_FTS_INDEX, schema=cls.fts_schema)
+            cls.fts_index.close()
+        elif get_schema_version(cls.fts_index.get_index().schema) != cls.FTS_SCHEMA_VERSION:
+            click.echo("Full text search index is out of date, rebuilding...")
+            cls.rebuild_fts()
+
+    #   Only indexes whose columns are present are created, columns added by later migrations
+    #   get their indexes when that migration runs
+    @classmethod
+    def create_indexes(cls, table_name):
+        columns_present = cls.get_table_columns(table_name)
+        for index_name, columns, is_unique in cls.indexes.get(table_name, []):
+            if all(c in columns_present for c in columns):
+                cls.run_query(r'create {}index if not exists {} on {} ({})'.format('unique ' if is_unique else '',
+                                                                                 index_name,
+                                                                                 table_name,
+                                                                                 ",".join(columns)))
+        return True
+
+    @classmethod
+    def get_table_columns(cls, table_name):
+        return [column[1] for column in cls.run_query(r'pragma table_info({})'.format(table_name), commit=False)]
+
+    @classmethod
+    def get_db_version(cls):
+        return cls.run_query(r'pragma user_version', commit=False)[0][0]
+
+    @classmethod
+    def set_db_version(cls, version):
+        # Pragmas do not accept bound parameters, hence the int() guard
+        return cls.run_query(r'pragma user_version = {}'.format(int(version)))
+
+    @classmethod
+    def migrate_db(cls):
+        current_version = cls.get_db_version()
+        for version, description, method_name in cls.migrations:
+            if version > current_version:
+                click.echo("Migrating database to version {}: {}...".format(version, description))
+                getattr(cls, method_name)()
+                cls.set_db_version(version)
+                current_version = version
+        return current_version
+
+    @classmethod
+    def _migrate_create_indexes(cls):
+        for table in cls.indexes:
+            if cls.check_for_table(table):
+                cls.create_indexes(table)
+
+    #   Hashes are backfilled in id order, a row whose content matches an earlier row keeps a null
+    #   hash so the unique index can still be built over databases that already hold duplicates
+    @classmethod
+    def _migrate_add_content_hash(cls):
+        for table, ref_type in ((cls.GAME_CITATION_TABLE, GAME_CITE_REF),
+                                (cls.PERFORMANCE_CITATION_TABLE, PERF_CITE_REF)):
+            if not cls.check_for_table(table):
+                continue
+            if 'content_hash' not in cls.get_table_columns(table):
+                cls.run_query(r'alter table {} add column content_hash text'.format(table))
+
+            seen = set()
+
+            def hashed_rows(rows):
+                for row in rows:
+                    content_hash = cls.create_cite_ref_from_db(ref_type, row).get_content_hash()
+                    if content_hash not in seen:
+                        seen.add(content_hash)
+                        yield (content_hash, row[0])
+
+            with cls.transaction():
+                rows = cls.run_query(r'select * from {} order by id'.format(table), commit=False)
+                cls.run_query(r'update {} set content_hash = ? where id = ?'.format(table), hashed_rows(rows), many=True)
+            cls.create_indexes(table)
 
     @classmethod
     def insert_into_table(cls, table_name, keys, values):
         query = 'insert into {}({}) values ({})'.format(table_name, #table to insert into
                                                          ",".join([k for k in keys]), #columns in table
                                                          ",".join([':{}'.format(k) for k in keys])) #mapping of columns ids to placeholder assignments for values
-        return cls.run_query(query, dict(zip(keys,values)))
+        return cls.run_write(query, dict(zip(keys,values)))
+
+    #   Inserts rows from any iterable (generators included) with a single prepared statement.
+    #   Rows are dicts keyed by column, or tuples ordered as 'keys' (default: the table headers).
+    @classmethod
+    def bulk_insert(cls, table_name, rows, keys=None):
+        rows = iter(rows)
+        try:
+            first = next(rows)
+        except StopIteration:
+            return 0
+        if isinstance(first, dict):
+            keys = keys or first.keys()
+            placeholders = ",".join([':{}'.format(k) for k in keys])
+        else:
+            keys = keys or cls.headers[table_name]
+            placeholders = ",".join(['?' for _ in keys])
+        query = 'insert into {}({}) values ({})'.format(table_name, ",".join(keys), placeholders)
+        return cls.run_write(query, chain([first], rows), many=True)
 
     @classmethod
     def update_table(cls, table_name, fields, values, where_fields, where_values, where_relation=AND):
         where_clause = cls.get_where_clause(where_fields, where_values, where_relation)
         set_clause = ", ".join(['{} = :{}'.format(f, f) for f in fields])
-        result = cls.run_query(r'update {} set {} where {}'.format(table_name, set_clause, where_clause),
-                               dict(zip(chain(fields, where_fields),chain(values, where_values))))
+        query = r'update {} set {} where {}'.format(table_name, set_clause, where_clause)
+        parameters = dict(zip(chain(fields, where_fields),chain(values, where_values)))
+        if table_name in (cls.GAME_CITATION_TABLE, cls.PERFORMANCE_CITATION_TABLE):
+            #   Content hashes follow the updated content, rows are found first in case 'fields' changes them
+            with cls.transaction():
+                ids = [row[0] for row in cls.run_query(r'select id from {} where {}'.format(table_name, where_clause),
+                                                       dict(zip(where_fields, where_values)), commit=False)]
+                result = cls.run_query(query, parameters)
+                cls.update_content_hashes(table_name, ids)
+        else:
+            result = cls.run_write(query, parameters)
+        cls.invalidate_cite_cache(table_name, where_fields, where_values)
+        if table_name in cls.fts_tables:
+            #   The index documents are rebuilt from the updated rows, so the write has to land first
+            result = cls.wait(result)
+            cls.reindex_fts(table_name, where_fields, where_values, where_relation)
         return result
 
+    #   Like the migration, a row whose content now matches another row gets a null hash to keep
+    #   the unique index valid
+    @classmethod
+    def update_content_hashes(cls, table_name, ids):
+        ref_type = GAME_CITE_REF if table_name == cls.GAME_CITATION_TABLE else PERF_CITE_REF
+        for id in ids:
+            row = cls.run_query(r'select * from {} where id=:id'.format(table_name), {'id': id}, commit=False)[0]
+            content_hash = cls.create_cite_ref_from_db(ref_type, row).get_content_hash()
+            cls.run_query(r'update {0} set content_hash = case when exists(select 1 from {0} where '
+                          r'content_hash=:content_hash and id!=:id) then null else :content_hash end '
+                          r'where id=:id'.format(table_name), {'content_hash': content_hash, 'id': id})
+
     @classmethod
     def delete_from_table(cls, table_name, fields, values, relation=AND):
         where_clause = cls.get_where_clause(fields, values, relation)
-        result = cls.run_query(r'delete from {} where {}'.format(table_name, where_clause), dict(zip(fields, values)))
+        result = cls.run_write(r'delete from {} where {}'.format(table_name, where_clause), dict(zip(fields, values)))
+        cls.invalidate_cite_cache(table_name, fields, values)
         return result
 
+    @classmethod
+    def invalidate_cite_cache(cls, table_name, where_fields=None, where_values=None):
+        if table_name not in (cls.GAME_CITATION_TABLE, cls.PERFORMANCE_CITATION_TABLE):
+            return
+        if where_fields and list(where_fields) == ['uuid']:
+            cls.cite_cache.invalidate(list(where_values)[0])
+        else:
+            cls.cite_cache.clear()
+
+    #   Unit of work for multi-statement writes, run_query skips its per statement commit while
+    #   inside, and the outermost block commits once on success or rolls back on any exception.
+    #   Nested blocks join the outermost one.
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        depth = getattr(cls._local, 'transaction_depth', 0)
+        cls._local.transaction_depth = depth + 1
+        try:
+            yield cls
+        except:
+            cls._local.transaction_depth = depth
+            if not depth:
+                cls.db.rollback()
+            raise
+        else:
+            cls._local.transaction_depth = depth
+            if not depth:
+                cls.db.commit()
+
+    @classmethod
+    def in_transaction(cls):
+        return getattr(cls._local, 'transaction_depth', 0) > 0
+
     @classmethod
     def run_query(cls, query, parameters=None, commit=True, many=False):
         try:
-            result = cls.db.execute(query, parameters) if parameters else cls.db.execute(query)
+            res = cls.execute_on_session(cls.db, query, parameters, many)
         except sqlite3.Error as e:
+            #   Let the enclosing transaction decide, rolling back here would discard its earlier statements
+            if cls.in_transaction():
+                raise
             cls.db.rollback()
             print e.message
             return None
 
+        # .commit() method is needed for changes to be saved, can create false positives in tests
+        # if left out since current connection will return its changes, but other connections will not see them
+        if commit and not cls.in_transaction():
+            cls.db.commit()
+        return res
+
+    #   Shared by run_query and the writer thread, returns fetched rows, or the affected row count for 'many'
+    @staticmethod
+    def execute_on_session(session, query, parameters=None, many=False):
+        if many:
+            #   executemany on the session's own DBAPI connection, so the statement is compiled once
+            #   and the parameter iterable is streamed rather than materialised
+            cursor = session.connection().connection.cursor()
+            try:
+                cursor.executemany(query, parameters)
+                return cursor.rowcount
+            finally:
+                cursor.close()
+
+        result = session.execute(query, parameters) if parameters else session.execute(query)
+
         # At some point the sqlalchemy interface either changed or introduced a bug on table creation
         # That returns an object for which fetchall() throws an error instead of returning a []
         # This catch will also eat legitimate ResourceClosedErrors, but those are mostly threaded issues
         # that we will probably not be particularly dealing with.
         try:
-            res = result.fetchall()
-        except ResourceClosedError as e:
-            res = []
+            return result.fetchall()
+        except ResourceClosedError:
+            return []
 
-        # .commit() method is needed for changes to be saved, can create false positives in tests
-        # if left out since current connection will return its changes, but other connections will not see them
-        if commit:
-            cls.db.commit()
-        return res
+    #   Optional single writer mode for the threaded server, writes outside of a transaction are
+    #   queued to one connection that group commits them, and the write methods return a WriteFuture
+    @classmethod
+    def start_writer(cls, max_batch=64, max_wait=0.01):
+        if not cls.writer:
+            cls.writer = WriteQueue(sessionmaker(bind=engine), cls.execute_on_session,
+                                    max_batch=max_batch, max_wait=max_wait)
+        return cls.writer
+
+    @classmethod
+    def stop_writer(cls):
+        if cls.writer:
+            writer, cls.writer = cls.writer, None
+            writer.stop()
 
     @classmethod
-    def retrieve_all_from_table(cls, table_name, start_index=0, limit=None):
-        return bound_array(cls.run_query(r'select * from {}'.format(table_name), commit=False), start_index, limit)
+    def run_write(cls, query, parameters=None, many=False):
+        if cls.writer and not cls.in_transaction():
+            return cls.writer.submit(query, parameters, many=many)
+        return cls.run_query(query, parameters, many=many)
+
+    #   Blocks on a queued write if needed, for callers that read back what they just wrote
+    @staticmethod
+    def wait(result, timeout=None):
+        return result.result(timeout) if isinstance(result, WriteFuture) else result
+
+    #   Pagination is pushed into SQL; 'limit' keeps the utils.bound_array meaning of an upper bound
+    #   counted from the start of the result set, 'after_id' is a keyset cursor on rowid (aliases 'id').
+    #   'columns' projects the select, rows then follow that column order instead of the table headers.
+    @classmethod
+    def select_page(cls, table_name, where_clause=None, parameters=None, start_index=0, limit=None, after_id=None,
+                    columns=None):
+        parameters = dict(parameters) if parameters else {}
+        conditions = ['({})'.format(where_clause)] if where_clause else []
+        if after_id is not None:
+            conditions.append('rowid > :page_after_id')
+            parameters['page_after_id'] = after_id
+        query = r'select {} from {}'.format(",".join(columns) if columns else '*', table_name)
+        if conditions:
+            query += ' where {}'.format(cls.AND.join(conditions))
+        if limit or start_index or after_id is not None:
+            query += ' order by rowid limit :page_limit offset :page_offset'
+            parameters['page_limit'] = max(limit - start_index, 0) if limit else -1
+            parameters['page_offset'] = start_index
+        return cls.run_query(query, parameters, commit=False)
+
+    @classmethod
+    def retrieve_all_from_table(cls, table_name, start_index=0, limit=None, after_id=None, columns=None):
+        return cls.select_page(table_name, start_index=start_index, limit=limit, after_id=after_id, columns=columns)
 
     @classmethod
     def is_attr_in_db(cls, attr, value, table_name):
-        return cls.run_query(r'select exists(select * from {0} where {1}=:{1})'.format(table_name, attr), {attr: value},
+        return cls.run_query(r'select exists(select 1 from {0} where {1}=:{1})'.format(table_name, attr), {attr: value},
                              commit=False) != [(0,)]
 
     @classmethod
-    def retrieve_attr_from_db(cls, attr, value, table_name, start_index=0, limit=None):
-        result = cls.run_query(r'select * from {0} where {1}=:{1}'.format(table_name, attr, attr),
-                               {attr: value},
-                               commit=False)
-        return bound_array(result, start_index, limit)
+    def retrieve_attr_from_db(cls, attr, value, table_name, start_index=0, limit=None, after_id=None, columns=None):
+        return cls.select_page(table_name, '{0}=:{0}'.format(attr), {attr: value},
+                               start_index=start_index, limit=limit, after_id=after_id, columns=columns)
 
     @classmethod
-    def retrieve_multiple_attr_from_db(cls, attrs, values, table_name, relation=OR, start_index=0, limit=None):
+    def retrieve_multiple_attr_from_db(cls, attrs, values, table_name, relation=OR, start_index=0, limit=None,
+                                       after_id=None, columns=None):
         where_clause = cls.get_where_clause(attrs, values, relation)
-        result = cls.run_query(r'select * from {} where {}'.format(table_name, where_clause),
-                             dict(zip(attrs, values)),
-                             commit=False)
-        return bound_array(result, start_index, limit)
+        return cls.select_page(table_name, where_clause, dict(zip(attrs, values)),
+                               start_index=start_index, limit=limit, after_id=after_id, columns=columns)
+
+    #   Queries search fts_search_fields unless they name a field (e.g. platform:NES or year:1986).
+    #   With 'stored_fields' each hit also carries the display fields stored in the index, enough to
+    #   list results without hydrating them from the database.
+    @classmethod
+    def retrieve_from_fts(cls, search_query, start_index=0, limit=None, stored_fields=False):
+        query = cls.fts_index.get_parser(cls.fts_search_fields).parse(search_query)
+        with cls.fts_index.searcher() as searcher:
+            #   Only score and collect as many hits as the requested bound, all of them without one
+            results_obj = searcher.search(query, limit=limit)
+            results = [cls.get_fts_hit(r, stored_fields) for r in results_obj[start_index:]]
+        return results
+
+    @staticmethod
+    def get_fts_hit(hit, stored_fields=False):
+        if stored_fields:
+            return dict(hit.fields(), uuid=hit['id'], tags=hit.get('tags'))
+        return dict(uuid=hit['id'], tags=hit.get('tags'))
+
+    #   One page of hits (pages count from 1) plus the total number of hits and, for each field in
+    #   'facets', the number of hits per value. Facets are counted over all hits by the searcher,
+    #   only the hits of the page are materialised.
+    @classmethod
+    def search_fts_page(cls, search_query, page=1, page_length=20, facets=fts_facet_fields, stored_fields=False):
+        query = cls.fts_index.get_parser(cls.fts_search_fields).parse(search_query)
+        facet_counts = sorting.Facets()
+        for field in facets:
+            facet_counts.add_field(field, maptype=sorting.Count)
+        with cls.fts_index.searcher() as searcher:
+            #   Whoosh raises on pages below 1, e.g. ?page=0 from a search URL
+            results_page = searcher.search_page(query, max(1, page), pagelen=page_length, groupedby=facet_counts)
+            return dict(hits=[cls.get_fts_hit(r, stored_fields) for r in results_page],
+                        total=results_page.total,
+                        page=results_page.pagenum,
+                        page_count=results_page.pagecount,
+                        page_length=page_length,
+                        #   Hits without a value are grouped under None or an empty string, leave them out
+                        facets=dict((field, dict((value, count) for value, count in results_page.results.groups(field).items()
+                                                 if value not in (None, u'')))
+                                    for field in facets))
+
+    #   Index writes are queued to a background writer that commits them in batches, so documents
+    #   become searchable after the next batch commit. Call flush_fts to wait for that.
+    @classmethod
+    def get_fts_writer(cls):
+        with cls._fts_writer_lock:
+            if not cls.fts_writer:
+                cls.fts_writer = FTSWriteQueue(cls.fts_index)
+                atexit.register(cls.stop_fts_writer)
+            return cls.fts_writer
 
     @classmethod
-    def retrieve_from_fts(cls, search_query, start_index=0, limit=None):
-        ix = open_dir(LOCAL_FTS_INDEX)
-        with ix.searcher() as searcher:
-            parser = QueryParser("content", ix.schema)
-            query = parser.parse(search_query)
-            results_obj = searcher.search(query)
-            results = [dict(uuid=r['id'],tags=r['tags']) for r in results_obj]
-        return bound_array(results, start_index, limit)
+    def flush_fts(cls, timeout=None):
+        if cls.fts_writer:
+            return cls.fts_writer.flush(timeout)
+        return True
+
+    #   Like flush_fts, returns False if queued index writes were lost
+    @classmethod
+    def stop_fts_writer(cls):
+        with cls._fts_writer_lock:
+            writer, cls.fts_writer = cls.fts_writer, None
+        if writer:
+            return writer.stop()
+        return True
+
+    @classmethod
+    def add_to_fts(cls, content, title=None, id=None, source_hash=None, tags=None, **display_fields):
+        cls.get_fts_writer().add_document(content=content, title=title, id=id, source_hash=source_hash, tags=tags,
+                                          **display_fields)
+
+    #   Index fields for a citation or a save state (any mapping of save state fields)
+    @classmethod
+    def get_cite_fts_fields(cls, cite_ref):
+        fields = dict((e, unicode(v)) for e, v in cite_ref.get_element_items() if v is not None and e in cls.fts_schema)
+        other_values = cite_ref.get_element_values(exclude=cls.fts_search_fields + cls.fts_excluded_elements)
+        fields.update(content=u" ".join([unicode(v) for v in other_values if v]),
+                      title=unicode(cite_ref['title']),
+                      id=unicode(cite_ref['uuid']),
+                      tags=cite_ref.ref_type,
+                      year=get_year(cite_ref['copyright_year']) if 'copyright_year' in cite_ref else None)
+        return fields
+
+    @staticmethod
+    def get_state_fts_fields(state):
+        return dict(content=u" ".join(x for x in state.values() if isinstance(x, str) or isinstance(x, unicode)),
+                    title=unicode(state.get('description')),
+                    source_hash=state.get('save_state_source_data'),
+                    tags=state.get('save_state_type'),
+                    id=unicode(state.get('uuid')),
+                    description=state.get('description'),
+                    game_uuid=unicode(state['game_uuid']) if state.get('game_uuid') else None)
 
+    #   Index fields for a full row of an indexed table
     @classmethod
-    def add_to_fts(cls, content, title=None, id=None, source_hash=None, tags=None):
-        ix = open_dir(LOCAL_FTS_INDEX)
-        writer = AsyncWriter(ix)
-        writer.add_document(content=content, title=title, id=id, source_hash=source_hash, tags=tags)
-        writer.commit()
+    def get_row_fts_fields(cls, table_name, row):
+        if table_name == cls.EXTRACTED_TABLE:
+            extracted = cls.get_record_type(table_name)(row)
+            return dict(content=get_plain_text(json.loads(extracted['metadata'])), source_hash=extracted['source_file_hash'],
+                        tags=u"extracted")
+        if table_name == cls.GAME_SAVE_TABLE:
+            return cls.get_state_fts_fields(cls.get_record_type(table_name)(row))
+        ref_type = GAME_CITE_REF if table_name == cls.GAME_CITATION_TABLE else PERF_CITE_REF
+        return cls.get_cite_fts_fields(cls.create_cite_ref_from_db(ref_type, row))
+
+    #   Replaces the index documents of the matching rows of an indexed table. Queued updates are
+    #   coalesced by id, so repeated updates of one row before the next batch commit index it once.
+    @classmethod
+    def reindex_fts(cls, table_name, where_fields, where_values, where_relation=AND):
+        rows = cls.retrieve_multiple_attr_from_db(where_fields, where_values, table_name, relation=where_relation)
+        writer = cls.get_fts_writer()
+        for row in rows:
+            writer.update_document(**cls.get_row_fts_fields(table_name, row))
+        return len(rows)
+
+    #   Index fields for every row of the extracted, citation and save state tables, read a page
+    #   of rows at a time by rowid
+    @classmethod
+    def iter_fts_documents(cls, page_size=1000):
+        for table_name in (cls.EXTRACTED_TABLE,) + cls.fts_tables:
+            after_id = None
+            while True:
+                rows = cls.retrieve_all_from_table(table_name, limit=page_size, after_id=after_id)
+                for row in rows:
+                    yield cls.get_row_fts_fields(table_name, row)
+                if len(rows) < page_size:
+                    break
+                after_id = rows[-1][0]
+
+    #   Rebuilds the full text index from the database next to the live index and swaps it in,
+    #   searches keep using the old index until then. Returns the number of documents indexed.
+    #   The live index stays write locked from before the table scan until the swap, so index
+    #   writes from this or another process (e.g. the server) wait for the rebuild to finish and
+    #   land in the new index rather than in the old one the swap drops.
+    @classmethod
+    def rebuild_fts(cls, procs=None, page_size=1000, lock_timeout=30.0):
+        #   Queued writes are in the database already, let them land before the index is replaced
+        cls.flush_fts()
+        build_dir = cls.fts_index.rebuild_dir
+        with cls.fts_index.write_lock(lock_timeout):
+            count = build_index(build_dir, cls.fts_schema, cls.iter_fts_documents(page_size), procs=procs)
+            cls.fts_index.swap_in(build_dir)
+        return count
+
+    @classmethod
+    def delete_from_fts(cls, id):
+        cls.get_fts_writer().delete_document(id)
 
     @classmethod
     def check_for_table(cls, table_name):
@@ -354,7 +902,7 @@ class DatabaseManager:
 
         result = cls.insert_into_table(cls.EXTRACTED_TABLE, cls.headers[cls.EXTRACTED_TABLE], db_values)
         if fts:
-            cls.add_to_fts(json.dumps(extracted_info),
+            cls.add_to_fts(get_plain_text(extracted_info),
                            source_hash=extracted_info.get("source_file_hash", None),
                            tags=u"extracted")
         return result
@@ -364,15 +912,24 @@ class DatabaseManager:
     # I assume its a duplicate and do not add it
     @classmethod
     def add_to_citation_table(cls, cite_ref, fts=False):
-        table = cls.GAME_CITATION_TABLE if cite_ref.ref_type == GAME_CITE_REF else cls.PERFORMANCE_CITATION_TABLE
+        table = cls.get_citation_table(cite_ref)
         if not cls.check_for_duplicate_citation(cite_ref, table):
             values = list(cite_ref.get_element_values())
             values.insert(0, None)                      # Primary Key
             values.append(datetime.now(tz=pytz.utc))    # Created timestamp
             values.append(cite_ref.to_json_string())    # Cite object
-            result = cls.insert_into_table(table, cls.headers[table], values)
+            values.append(cite_ref.get_content_hash())  # Content hash
+            #   Waits for a queued insert, the unique content hash index only rejects a duplicate then
+            try:
+                result = cls.wait(cls.insert_into_table(table, cls.headers[table], values))
+            except IntegrityError:
+                #   An identical citation was added by another thread after the check above.
+                #   The failed statement changed nothing, so an enclosing transaction carries on.
+                if not cls.in_transaction():
+                    cls.db.rollback()
+                return False
             if fts:
-                cls.add_to_fts(cite_ref.to_json_string(), title=unicode(cite_ref['title']), id=unicode(cite_ref['uuid']), tags=cite_ref.ref_type)
+                cls.add_to_fts(**cls.get_cite_fts_fields(cite_ref))
             return result
         return False
 
@@ -399,13 +956,10 @@ class DatabaseManager:
         values.append(fields.get('has_screen'))
         values.append(fields.get('created_on'))
         values.append(fields.get('created'))
-        result = cls.insert_into_table(table, cls.headers[table], values)
+        #   Callers go on to use the returned uuid, so the row must exist before returning
+        result = cls.wait(cls.insert_into_table(table, cls.headers[table], values))
         if fts:
-            cls.add_to_fts(u" ".join(x for x in fields.values() if isinstance(x, str) or isinstance(x, unicode)),
-                           title=unicode(fields.get('description')),
-                           source_hash=fields.get('save_state_source_data'),
-                           tags=fields.get('save_state_type'),
-                           id=unicode(fields.get('uuid', uid)))
+            cls.add_to_fts(**cls.get_state_fts_fields(dict(fields, uuid=fields.get('uuid', uid))))
         return uid
 
 
@@ -424,7 +978,7 @@ class DatabaseManager:
 
     @classmethod
     def add_screen_to_state(cls, uuid):
-        cls.update_table(cls.GAME_SAVE_TABLE, ('has_screen',), (True,), ['uuid'], [uuid])
+        cls.wait(cls.update_table(cls.GAME_SAVE_TABLE, ('has_screen',), (True,), ['uuid'], [uuid]))
         return True
 
     #   Copy existing file information to new record for save_state
@@ -445,9 +999,9 @@ class DatabaseManager:
     def link_save_state_to_performance(cls, state_uuid, perf_uuid, time_index, action):
         if cls.is_attr_in_db('uuid', state_uuid, cls.GAME_SAVE_TABLE) and \
                 cls.is_attr_in_db('uuid', perf_uuid, cls.PERFORMANCE_CITATION_TABLE):
-            cls.insert_into_table(cls.SAVE_STATE_PERFORMANCE_LINK_TABLE,
-                                  ['performance_uuid', 'save_state_uuid', 'time_index', 'action'],
-                                  [perf_uuid, state_uuid, time_index, action])
+            cls.wait(cls.insert_into_table(cls.SAVE_STATE_PERFORMANCE_LINK_TABLE,
+                                           ['performance_uuid', 'save_state_uuid', 'time_index', 'action'],
+                                           [perf_uuid, state_uuid, time_index, action]))
             return cls.retrieve_state_perf_link(state_uuid, perf_uuid)
         else:
             return None
@@ -472,12 +1026,27 @@ class DatabaseManager:
 
     @classmethod
     def check_for_duplicate_citation(cls, cite_ref, table):
-        # UUID for incoming cite_ref check will most likely always be unique
-        where_clause_keys = cls.get_where_clause(cite_ref.get_element_names(exclude=['uuid']), cite_ref.get_element_values(exclude=['uuid']), cls.AND)
-        query = r'select exists(select * from {} where {})'.format(table, where_clause_keys)
-        result = cls.run_query(query, dict(cite_ref.get_element_items(exclude=['uuid'])), commit=False)
+        # UUID for incoming cite_ref check will most likely always be unique, so it is left out of the hash
+        query = r'select exists(select 1 from {} where content_hash=:content_hash)'.format(table)
+        result = cls.run_query(query, {'content_hash': cite_ref.get_content_hash()}, commit=False)
         return result != [(0,)]
 
+    #   uuid of the stored citation 'cite_ref' duplicates, or None
+    @classmethod
+    def get_duplicate_citation_uuid(cls, cite_ref):
+        query = r'select uuid from {} where content_hash=:content_hash'.format(cls.get_citation_table(cite_ref))
+        result = cls.run_query(query, {'content_hash': cite_ref.get_content_hash()}, commit=False)
+        return result[0][0] if result else None
+
+    @classmethod
+    def get_citation_table(cls, cite_ref):
+        return cls.GAME_CITATION_TABLE if cite_ref.ref_type == GAME_CITE_REF else cls.PERFORMANCE_CITATION_TABLE
+
+    @staticmethod
+    def get_column_list(columns=None, table_alias=None):
+        prefix = '{}.'.format(table_alias) if table_alias else ''
+        return ",".join(['{}{}'.format(prefix, c) for c in columns]) if columns else '{}*'.format(prefix)
+
     @staticmethod
     def get_where_clause(keys, values, relation):
         return relation.join(map(lambda kv: "{}=:{}".format(kv[0], kv[0]) if kv[1] else "{} is null".format(kv[0]), zip(keys, values)))
@@ -486,50 +1055,120 @@ class DatabaseManager:
     def get_where_clause_k_v(keys, var_names, values, relation):
         return relation.join(map(lambda kv: "{}:={}".format(kv[0],kv[1]) if kv[2] else "{} is null".format(kv[0]), zip(keys, var_names, values)))
 
+    #   Returns the performance and its ancestors via previous_performance_uuid, oldest first and
+    #   the given performance last, in a single recursive query. max_depth limits the ancestors walked.
     @classmethod
-    def retrieve_performance_chain(cls, performance_uuid):
-        if cls.is_attr_in_db('uuid', performance_uuid, cls.PERFORMANCE_CITATION_TABLE):
-            current_db_values = cls.retrieve_attr_from_db('uuid', performance_uuid, cls.PERFORMANCE_CITATION_TABLE, limit=1)[0]
-            current = cls.create_cite_ref_from_db(PERF_CITE_REF, current_db_values)
-            current_prev_uuid = current['previous_performance_uuid']
-            performance_chain = [current]
+    def retrieve_performance_chain(cls, performance_uuid, max_depth=None, columns=None):
+        query = r'''with recursive chain(id, previous_uuid, depth) as (
+                          select id, previous_performance_uuid, 0 from {0} where uuid=:uuid
+                          union all
+                          select p.id, p.previous_performance_uuid, chain.depth + 1
+                          from {0} p join chain on p.uuid = chain.previous_uuid
+                          where :max_depth is null or chain.depth < :max_depth
+                      )
+                      select {1} from chain join {0} p on p.id = chain.id
+                      order by chain.depth desc'''.format(cls.PERFORMANCE_CITATION_TABLE, cls.get_column_list(columns, 'p'))
+        chain = cls.run_query(query, {'uuid': performance_uuid, 'max_depth': max_depth}, commit=False)
+        return [cls.create_cite_ref_from_db(PERF_CITE_REF, p_tuple, columns) for p_tuple in chain]
 
-            if current_prev_uuid:
-                prev = cls.retrieve_attr_from_db('uuid', current_prev_uuid, cls.PERFORMANCE_CITATION_TABLE)[0]
-                while prev:
-                    prev_cite = cls.create_cite_ref_from_db(PERF_CITE_REF, prev)
-                    performance_chain.insert(0, prev_cite)
-                    prev_uuid = prev_cite['previous_performance_uuid']
-                    prev = cls.retrieve_attr_from_db('uuid', prev_uuid, cls.PERFORMANCE_CITATION_TABLE)[0] if prev_uuid else None
-            return performance_chain
-        return []
+    #   Returns performances re-recorded from the given performance, nearest first, not including
+    #   the given performance itself. max_depth limits how many generations are walked.
+    @classmethod
+    def retrieve_performance_descendants(cls, performance_uuid, max_depth=None, columns=None):
+        query = r'''with recursive descendants(id, uuid, depth) as (
+                          select id, uuid, 0 from {0} where uuid=:uuid
+                          union all
+                          select p.id, p.uuid, descendants.depth + 1
+                          from {0} p join descendants on p.previous_performance_uuid = descendants.uuid
+                          where :max_depth is null or descendants.depth < :max_depth
+                      )
+                      select {1} from descendants join {0} p on p.id = descendants.id
+                      where descendants.depth > 0
+                      order by descendants.depth, p.id'''.format(cls.PERFORMANCE_CITATION_TABLE, cls.get_column_list(columns, 'p'))
+        descendants = cls.run_query(query, {'uuid': performance_uuid, 'max_depth': max_depth}, commit=False)
+        return [cls.create_cite_ref_from_db(PERF_CITE_REF, p_tuple, columns) for p_tuple in descendants]
 
     @classmethod
     def retrieve_game_ref(cls, game_uuid):
-        if cls.is_attr_in_db('uuid', game_uuid, cls.GAME_CITATION_TABLE):
-            db_values = cls.retrieve_attr_from_db('uuid', game_uuid, cls.GAME_CITATION_TABLE, limit=1)[0]
-            game_cite = cls.create_cite_ref_from_db(GAME_CITE_REF, db_values)
-            return game_cite
-        return None
+        return cls.retrieve_cite_ref(GAME_CITE_REF, game_uuid)
 
     @classmethod
     def retrieve_perf_ref(cls, perf_uuid):
-        if cls.is_attr_in_db('uuid', perf_uuid, cls.PERFORMANCE_CITATION_TABLE):
-            db_values = cls.retrieve_attr_from_db('uuid', perf_uuid, cls.PERFORMANCE_CITATION_TABLE, limit=1)[0]
-            perf_cite = cls.create_cite_ref_from_db(PERF_CITE_REF, db_values)
-            return perf_cite
+        return cls.retrieve_cite_ref(PERF_CITE_REF, perf_uuid)
+
+    @classmethod
+    def retrieve_cite_ref(cls, ref_type, cite_uuid):
+        cite_ref = cls.cite_cache.get(cite_uuid)
+        if cite_ref and cite_ref.ref_type == ref_type:
+            return cite_ref.copy()
+
+        table = cls.GAME_CITATION_TABLE if ref_type == GAME_CITE_REF else cls.PERFORMANCE_CITATION_TABLE
+        #   An update between the read and the put invalidates first, the old row then isn't cached
+        cache_version = cls.cite_cache.version()
+        db_values = cls.retrieve_attr_from_db('uuid', cite_uuid, table, limit=1)
+        if db_values:
+            cite_ref = cls.create_cite_ref_from_db(ref_type, db_values[0])
+            cls.cite_cache.put(cite_uuid, cite_ref, version=cache_version)
+            return cite_ref.copy()
         return None
 
+    #   Rows for many uuids, one 'uuid in (...)' query per 'chunk_size' uuids to stay under SQLite's
+    #   bound parameter limit. Returns a dict of uuid to row.
+    @classmethod
+    def retrieve_rows_by_uuid(cls, table_name, uuids, columns=None, chunk_size=500):
+        uuid_position = list(columns or cls.headers[table_name]).index('uuid')
+        uuids = list(uuids)
+        rows = {}
+        for i in range(0, len(uuids), chunk_size):
+            parameters = dict(('uuid_{}'.format(n), u) for n, u in enumerate(uuids[i:i + chunk_size]))
+            where_clause = 'uuid in ({})'.format(",".join([':{}'.format(k) for k in parameters]))
+            for row in cls.select_page(table_name, where_clause, parameters, columns=columns):
+                rows[row[uuid_position]] = row
+        return rows
+
+    #   Batched retrieve_cite_ref, citations come back in the order of 'uuids' and missing ones are skipped
+    @classmethod
+    def retrieve_cite_refs(cls, ref_type, uuids):
+        cite_refs = {}
+        for cite_uuid in uuids:
+            cite_ref = cls.cite_cache.get(cite_uuid)
+            if cite_ref and cite_ref.ref_type == ref_type:
+                cite_refs[cite_uuid] = cite_ref
+        table = cls.GAME_CITATION_TABLE if ref_type == GAME_CITE_REF else cls.PERFORMANCE_CITATION_TABLE
+        cache_version = cls.cite_cache.version()
+        for cite_uuid, row in cls.retrieve_rows_by_uuid(table, [u for u in uuids if u not in cite_refs]).items():
+            cite_refs[cite_uuid] = cls.create_cite_ref_from_db(ref_type, row)
+            cls.cite_cache.put(cite_uuid, cite_refs[cite_uuid], version=cache_version)
+        return [cite_refs[u].copy() for u in uuids if u in cite_refs]
+
+    @classmethod
+    def retrieve_save_states(cls, uuids, columns=None):
+        rows = cls.retrieve_rows_by_uuid(cls.GAME_SAVE_TABLE, uuids, columns)
+        state_record = cls.get_record_type(cls.GAME_SAVE_TABLE, columns)
+        return [state_record(rows[u]) for u in uuids if u in rows]
+
+    @classmethod
+    def retrieve_derived_performances(cls, game_uuid, columns=None):
+        perfs = cls.retrieve_attr_from_db('game_uuid', game_uuid, cls.PERFORMANCE_CITATION_TABLE, columns=columns)
+        return [cls.create_cite_ref_from_db(PERF_CITE_REF, p_tuple, columns) for p_tuple in perfs if p_tuple != (0,)]
+
+    #   Row class for a table, or for a projection of it, built once and reused
     @classmethod
-    def retrieve_derived_performances(cls, game_uuid):
-        perfs = cls.retrieve_attr_from_db('game_uuid', game_uuid, cls.PERFORMANCE_CITATION_TABLE)
-        return [cls.create_cite_ref_from_db(PERF_CITE_REF, p_tuple) for p_tuple in perfs if p_tuple != (0,)]
+    def get_record_type(cls, table_name, columns=None):
+        key = (table_name, tuple(columns) if columns else None)
+        record_class = cls._record_types.get(key)
+        if not record_class:
+            name = ''.join([w.capitalize() for w in table_name.split('_')]) + 'Record'
+            record_class = cls._record_types[key] = record_type(name, columns or cls.headers[table_name])
+        return record_class
 
-    #   For now returns list of dicts with relevant state information
+    #   For now returns list of records with relevant state information
     @classmethod
-    def retrieve_save_state(cls, **fields):
-        states =  cls.retrieve_multiple_attr_from_db(fields.keys(), fields.values(), cls.GAME_SAVE_TABLE, cls.AND)
-        return [OrderedDict(zip(cls.headers[cls.GAME_SAVE_TABLE], state_tuple)) for state_tuple in states]
+    def retrieve_save_state(cls, columns=None, **fields):
+        states =  cls.retrieve_multiple_attr_from_db(fields.keys(), fields.values(), cls.GAME_SAVE_TABLE, cls.AND,
+                                                     columns=columns)
+        state_record = cls.get_record_type(cls.GAME_SAVE_TABLE, columns)
+        return [state_record(state_tuple) for state_tuple in states]
 
     @classmethod
     def retrieve_state_perf_link(cls, state_uuid, perf_uuid):
@@ -537,30 +1176,36 @@ class DatabaseManager:
                                                   [state_uuid, perf_uuid],
                                                   cls.SAVE_STATE_PERFORMANCE_LINK_TABLE, cls.AND)
         if link:
-            return OrderedDict(zip(cls.headers[cls.SAVE_STATE_PERFORMANCE_LINK_TABLE], link[0]))
+            return cls.get_record_type(cls.SAVE_STATE_PERFORMANCE_LINK_TABLE)(link[0])
         else:
             return None
 
     @classmethod
     def retrieve_all_state_perf_links(cls, perf_uuid):
-        links = cls.retrieve_multiple_attr_from_db(['performance_uuid'],
-                                                   [perf_uuid],
-                                                   cls.SAVE_STATE_PERFORMANCE_LINK_TABLE)
-        link_info = [{'state_record': cls.retrieve_save_state(uuid=link[cls.headers[cls.SAVE_STATE_PERFORMANCE_LINK_TABLE].index('save_state_uuid')])[0],
-                      'time_index': link[cls.headers[cls.SAVE_STATE_PERFORMANCE_LINK_TABLE].index('time_index')],
-                      'action': link[cls.headers[cls.SAVE_STATE_PERFORMANCE_LINK_TABLE].index('action')]} for link in links]
+        state_record = cls.get_record_type(cls.GAME_SAVE_TABLE)
+        num_state_fields = len(state_record._fields)
+        query = r'''select s.*, l.time_index, l.action from {} l join {} s on s.uuid = l.save_state_uuid
+                      where l.performance_uuid=:performance_uuid
+                      order by l.time_index, l.rowid'''.format(cls.SAVE_STATE_PERFORMANCE_LINK_TABLE, cls.GAME_SAVE_TABLE)
+        links = cls.run_query(query, {'performance_uuid': perf_uuid}, commit=False)
+        link_info = [{'state_record': state_record(link[:num_state_fields]),
+                      'time_index': link[num_state_fields],
+                      'action': link[num_state_fields + 1]} for link in links]
         return link_info
 
-    #   For now returns list of dicts with relevant path information
+    #   For now returns list of records with relevant path information
     @classmethod
-    def retrieve_file_path(cls, **fields):
-        paths = cls.retrieve_multiple_attr_from_db(fields.keys(), fields.values(), cls.GAME_FILE_PATH_TABLE, cls.AND)
-        return [OrderedDict(zip(cls.headers[cls.GAME_FILE_PATH_TABLE], path_tuple)) for path_tuple in paths]
+    def retrieve_file_path(cls, columns=None, **fields):
+        paths = cls.retrieve_multiple_attr_from_db(fields.keys(), fields.values(), cls.GAME_FILE_PATH_TABLE, cls.AND,
+                                                   columns=columns)
+        path_record = cls.get_record_type(cls.GAME_FILE_PATH_TABLE, columns)
+        return [path_record(path_tuple) for path_tuple in paths]
 
+    #   'columns' names the columns of a projected db_tuple, elements left out of it are None
     @classmethod
-    def create_cite_ref_from_db(cls, ref_type, db_tuple):
+    def create_cite_ref_from_db(cls, ref_type, db_tuple, columns=None):
         if ref_type == GAME_CITE_REF:
-            db_row_dict = dict(zip(cls.headers[cls.GAME_CITATION_TABLE], db_tuple))
+            db_row_dict = dict(zip(columns or cls.headers[cls.GAME_CITATION_TABLE], db_tuple))
         elif ref_type == PERF_CITE_REF:
-            db_row_dict = dict(zip(cls.headers[cls.PERFORMANCE_CITATION_TABLE], db_tuple))
+            db_row_dict = dict(zip(columns or cls.headers[cls.PERFORMANCE_CITATION_TABLE], db_tuple))
         return generate_cite_ref(ref_type, **db_row_dict)  # Schema version is already present
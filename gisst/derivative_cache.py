@@ -0,0 +1,145 @@
+__author__ = 'erickaltman'
+
+#   On disk cache for files derived from citation data, like GIFs and clips of performance videos.
+#   Files are addressed by a hash of everything that determines their content, so a repeated
+#   request finds the earlier render. Once the cache grows past 'max_size' bytes the least
+#   recently used files are deleted, a file's modification time marks its last use.
+
+import os
+import json
+import errno
+import hashlib
+import threading
+from collections import OrderedDict
+
+#   Render parameters that make up a cache key, in key order
+DERIVATIVE_PARAMS = ('source_hash', 'start', 'end', 'fps', 'width', 'format')
+
+
+class DerivativeCache(object):
+
+    def __init__(self, cache_dir, max_size=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = None    # file ref -> size, least recently used first
+        self._size = 0
+        self._lock = threading.RLock()
+
+    #   File reference relative to the cache directory, e.g. 'ab/ab12...ef.gif'
+    def get_file_ref(self, params):
+        key = hashlib.sha1(json.dumps([unicode(params[p]) for p in DERIVATIVE_PARAMS])).hexdigest()
+        return "{}/{}.{}".format(key[:2], key, params['format'])
+
+    def get_path(self, file_ref):
+        return os.path.join(self.cache_dir, file_ref)
+
+    #   File reference of a cached derivative, or None. A hit counts as a use.
+    def get(self, params):
+        file_ref = self.get_file_ref(params)
+        with self._lock:
+            entries = self._get_entries()
+            if file_ref not in entries or not os.path.exists(self.get_path(file_ref)):
+                self._forget(file_ref)
+                self.misses += 1
+                return None
+            entries[file_ref] = entries.pop(file_ref)
+            self.hits += 1
+        try:
+            os.utime(self.get_path(file_ref), None)
+        except OSError:
+            pass
+        return file_ref
+
+    #   Path to write a new derivative to before it's added with store()
+    def get_temp_path(self, params):
+        path = self.get_path(self.get_file_ref(params))
+        self._make_dirs(os.path.dirname(path))
+        root, ext = os.path.splitext(path)
+        return "{}.{}.tmp{}".format(root, threading.current_thread().ident, ext)
+
+    #   Moves a finished file into the cache, evicting old files if needed, and returns its reference
+    def store(self, params, temp_path):
+        file_ref = self.get_file_ref(params)
+        path = self.get_path(file_ref)
+        os.rename(temp_path, path)
+        with self._lock:
+            self._forget(file_ref)
+            self._get_entries()[file_ref] = os.path.getsize(path)
+            self._size += self._entries[file_ref]
+            self._evict()
+        return file_ref
+
+    #   Renders with render(temp_path) unless the derivative is cached
+    def get_or_render(self, params, render):
+        file_ref = self.get(params)
+        if file_ref is None:
+            temp_path = self.get_temp_path(params)
+            try:
+                render(temp_path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            file_ref = self.store(params, temp_path)
+        return file_ref
+
+    def discard(self, params):
+        file_ref = self.get_file_ref(params)
+        with self._lock:
+            self._forget(file_ref)
+            self._remove_file(file_ref)
+
+    def stats(self):
+        with self._lock:
+            entries = self._get_entries()
+            return {'entries': len(entries), 'size': self._size, 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    #   Files already on disk are picked up on first use, oldest first
+    def _get_entries(self):
+        if self._entries is None:
+            files = []
+            if os.path.isdir(self.cache_dir):
+                for dir_name in os.listdir(self.cache_dir):
+                    dir_path = os.path.join(self.cache_dir, dir_name)
+                    if not os.path.isdir(dir_path):
+                        continue
+                    for file_name in os.listdir(dir_path):
+                        if '.tmp' in file_name:
+                            continue
+                        info = os.stat(os.path.join(dir_path, file_name))
+                        files.append((info.st_mtime, "{}/{}".format(dir_name, file_name), info.st_size))
+            self._entries = OrderedDict((file_ref, size) for _, file_ref, size in sorted(files))
+            self._size = sum(self._entries.values())
+        return self._entries
+
+    def _forget(self, file_ref):
+        size = self._get_entries().pop(file_ref, None)
+        if size is not None:
+            self._size -= size
+
+    #   The newest file is kept even if it's larger than the cache on its own
+    def _evict(self):
+        entries = self._get_entries()
+        while self._size > self.max_size and len(entries) > 1:
+            file_ref = next(iter(entries))
+            self._forget(file_ref)
+            self._remove_file(file_ref)
+            self.evictions += 1
+
+    def _remove_file(self, file_ref):
+        try:
+            os.remove(self.get_path(file_ref))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _make_dirs(self, path):
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
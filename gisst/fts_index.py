@@ -0,0 +1,372 @@
+__author__ = 'erickaltman'
+
+#   Process wide handle on the Whoosh full text index. Opening the index reads the table of
+#   contents and every segment, which costs more than a small search does, so the index stays
+#   open and searchers are pooled, a pooled searcher is only refreshed when a writer has committed
+#   a new generation.
+#   Index writes go through FTSWriteQueue, which commits documents in batches from one thread
+#   instead of writing a new segment per document.
+
+import os
+import time
+import shutil
+import threading
+import Queue
+from multiprocessing import cpu_count
+from contextlib import contextmanager
+from whoosh.index import open_dir, create_in, TOC, LockError, clean_files
+from whoosh.filedb.filestore import FileStorage
+from whoosh.util.filelock import try_for
+from whoosh.fields import Schema
+from whoosh.qparser import QueryParser, MultifieldParser
+from whoosh.writing import AsyncWriter
+
+INDEX_NAME = 'MAIN'     # Whoosh default index name
+
+
+#   The schema version is kept as an attribute of the schema object, which whoosh pickles into
+#   the index's table of contents. Indexes from before versioning count as version 1.
+def versioned_schema(version, **fields):
+    schema = Schema(**fields)
+    schema.version = version
+    return schema
+
+
+def get_schema_version(schema):
+    return getattr(schema, 'version', 1)
+
+
+class FTSIndexManager(object):
+
+    def __init__(self, index_dir, schema):
+        self.index_dir = index_dir
+        self.schema = schema
+        self._index = None
+        self._parsers = {}
+        self._lock = threading.RLock()
+        #   Idle searchers of the current epoch, close() starts a new epoch
+        self._searchers = []
+        self._epoch = 0
+        self.opens = 0
+        self.refreshes = 0
+
+    def get_index(self):
+        with self._lock:
+            if self._index is None:
+                self._index = open_dir(self.index_dir)
+            return self._index
+
+    #   A tuple of fields gets a parser that searches all of them
+    def get_parser(self, fields):
+        parser = self._parsers.get(fields)
+        if parser is None:
+            if isinstance(fields, tuple):
+                parser = MultifieldParser(fields, self.get_index().schema)
+            else:
+                parser = QueryParser(fields, self.get_index().schema)
+            self._parsers[fields] = parser
+        return parser
+
+    #   Whoosh searchers aren't safe to share between threads, so a search borrows an idle searcher
+    #   from the pool, or opens one if all are in use, and returns it afterwards. The server runs
+    #   each request on a new thread, so searchers outlive the threads that use them. refresh()
+    #   keeps the readers of segments that didn't change. A searcher borrowed before close() is
+    #   closed when it's returned.
+    @contextmanager
+    def searcher(self):
+        with self._lock:
+            epoch = self._epoch
+            if self._searchers:
+                searcher, index = self._searchers.pop(), None
+            else:
+                searcher, index = None, self.get_index()
+                self.opens += 1
+        if searcher is None:
+            searcher = index.searcher()
+        elif not searcher.up_to_date():
+            searcher = searcher.refresh()
+            with self._lock:
+                self.refreshes += 1
+        try:
+            yield searcher
+        finally:
+            with self._lock:
+                if epoch == self._epoch:
+                    self._searchers.append(searcher)
+                    searcher = None
+            if searcher is not None:
+                searcher.close()
+
+    #   AsyncWriter falls back to a background thread if another writer holds the lock,
+    #   a blocking writer waits up to 'timeout' seconds for the lock instead
+    def writer(self, blocking=False, timeout=0.0):
+        return self.get_index().writer(timeout=timeout) if blocking else AsyncWriter(self.get_index())
+
+    #   rebuild_fts builds the replacement index here, the directory only exists while a rebuild runs
+    @property
+    def rebuild_dir(self):
+        return self.index_dir + '_rebuild'
+
+    def rebuilding(self):
+        return os.path.exists(self.rebuild_dir)
+
+    #   Holds the index write lock, the lock writers take, so no writer can commit meanwhile.
+    #   There is nothing to lock until the index directory exists.
+    @contextmanager
+    def write_lock(self, timeout=30.0):
+        if not os.path.exists(self.index_dir):
+            yield
+            return
+        lock = FileStorage(self.index_dir).lock(INDEX_NAME + '_WRITELOCK')
+        if not try_for(lock.acquire, timeout=timeout, delay=0.1):
+            raise LockError('Could not lock the full text index.')
+        try:
+            yield
+        finally:
+            lock.release()
+
+    #   Installs the index built in 'build_dir' in place of this one.
+    def replace_with(self, build_dir, lock_timeout=30.0):
+        with self.write_lock(lock_timeout):
+            self.swap_in(build_dir)
+
+    #   Like replace_with, for callers already holding write_lock. The built segments are moved in
+    #   and committed as a new generation, the same way a writer commits, so open searchers keep
+    #   reading the old segments until they refresh. A missing index directory is just replaced.
+    def swap_in(self, build_dir):
+        if not os.path.exists(self.index_dir):
+            os.rename(build_dir, self.index_dir)
+            self.close()
+            return
+
+        built = FileStorage(build_dir)
+        toc = TOC.read(built, INDEX_NAME)
+        storage = FileStorage(self.index_dir)
+        segment_pattern = TOC._segment_pattern(INDEX_NAME)
+        for filename in built:
+            if segment_pattern.match(filename):
+                os.rename(os.path.join(build_dir, filename), os.path.join(self.index_dir, filename))
+        generation = TOC._latest_generation(storage, INDEX_NAME) + 1
+        TOC(toc.schema, toc.segments, generation).write(storage, INDEX_NAME)
+        clean_files(storage, INDEX_NAME, generation, toc.segments)
+        shutil.rmtree(build_dir)
+        #   The schema may have changed along with the index
+        self.close()
+
+    #   Drop open handles, needed if the index directory is recreated or replaced. Searchers in
+    #   use by other threads are closed when they're returned.
+    def close(self):
+        with self._lock:
+            for searcher in self._searchers:
+                searcher.close()
+            self._searchers = []
+            if self._index is not None:
+                self._index.close()
+            self._index = None
+            self._parsers = {}
+            self._epoch += 1
+
+
+#   Builds a fresh, optimized index in 'build_dir' from an iterable of document field dicts.
+#   With more than one process documents are handed to whoosh's multiprocessing writer.
+def build_index(build_dir, schema, documents, procs=None):
+    if os.path.exists(build_dir):
+        shutil.rmtree(build_dir)
+    os.mkdir(build_dir)
+    ix = create_in(build_dir, schema=schema)
+    procs = procs or cpu_count()
+    writer = ix.writer(procs=procs, multisegment=False) if procs > 1 else ix.writer()
+    count = 0
+    try:
+        for fields in documents:
+            writer.add_document(**fields)
+            count += 1
+    except BaseException:
+        writer.cancel()
+        ix.close()
+        shutil.rmtree(build_dir)
+        raise
+    writer.commit(optimize=True)
+    ix.close()
+    return count
+
+
+#   Operations accepted by FTSWriteQueue
+FTS_ADD = 'add'
+FTS_UPDATE = 'update'
+FTS_DELETE = 'delete'
+FTS_FLUSH = 'flush'
+
+
+class FTSWriteQueue(object):
+
+    #   A batch is committed once it holds 'max_batch' operations or 'max_wait' seconds after
+    #   its first operation arrived, whichever comes first. If the index stays locked for
+    #   'lock_timeout' seconds the batch is retried up to 'lock_retries' times, with a growing
+    #   pause between attempts, before it's given up on.
+    def __init__(self, fts_index, max_batch=256, max_wait=0.5, lock_timeout=30.0, lock_retries=3, retry_delay=1.0):
+        self.fts_index = fts_index
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.lock_timeout = lock_timeout
+        self.lock_retries = lock_retries
+        self.retry_delay = retry_delay
+        self.queue = Queue.Queue()
+        #   Fields of queued updates by document id, a queued update only carries the id
+        self._updates = {}
+        self._updates_lock = threading.Lock()
+        self.commits = 0
+        self.documents = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_error = None
+        #   Set when a write is lost, reported and cleared by the next flush
+        self._failed = False
+        self.thread = threading.Thread(target=self._run, name='gisst-fts-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add_document(self, **fields):
+        self.queue.put((FTS_ADD, fields))
+
+    #   Replaces the document with the same id. If an update for that id is still queued only
+    #   its fields are replaced, so a document updated repeatedly is written once.
+    def update_document(self, **fields):
+        id = fields['id']
+        with self._updates_lock:
+            queued = id in self._updates
+            self._updates[id] = fields
+            if queued:
+                self.coalesced += 1
+            else:
+                self.queue.put((FTS_UPDATE, id))
+
+    def delete_document(self, id):
+        self.queue.put((FTS_DELETE, id))
+
+    def backlog(self):
+        return self.queue.qsize()
+
+    #   Blocks until everything queued before the call is committed. Returns False on a timeout,
+    #   or if a batch failed or a document was skipped since the previous flush.
+    def flush(self, timeout=None):
+        request = FlushRequest()
+        self.queue.put((FTS_FLUSH, request))
+        return request.wait(timeout)
+
+    #   Commits what's queued and stops the writer thread, returns False like flush if writes were lost
+    def stop(self):
+        request = FlushRequest()
+        self.queue.put((FTS_FLUSH, request))
+        self.queue.put(None)
+        self.thread.join()
+        return request.wait(0)
+
+    def stats(self):
+        return dict(backlog=self.backlog(), commits=self.commits, documents=self.documents,
+                    coalesced=self.coalesced, failures=self.failures, skipped=self.skipped)
+
+    def _next_batch(self, first):
+        batch, flushed = [], []
+        item = first
+        deadline = time.time() + self.max_wait
+        while item is not None:
+            if item[0] == FTS_FLUSH:
+                flushed.append(item[1])
+                break
+            batch.append(item)
+            if len(batch) >= self.max_batch:
+                break
+            remaining = deadline - time.time()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except Queue.Empty:
+                break
+        return batch, flushed, item is None
+
+    def _run(self):
+        stopped = False
+        while not stopped:
+            batch, flushed, stopped = self._next_batch(self.queue.get())
+            if batch:
+                self._commit(batch)
+            for request in flushed:
+                request.set(not self._failed)
+                self._failed = False
+
+    def _fail(self, error):
+        self.failures += 1
+        self.last_error = error
+        self._failed = True
+        print 'Full text index write failed: {}'.format(error)
+
+    #   Blocking writer, retried while another process holds the index lock. A rebuild holds the
+    #   lock until its new index is swapped in, however long that takes, so it's waited out
+    #   without using up retries. If the rebuilding process dies its lock goes with it.
+    def _get_writer(self):
+        attempt = 0
+        while True:
+            try:
+                return self.fts_index.writer(blocking=True, timeout=self.lock_timeout)
+            except LockError:
+                if self.fts_index.rebuilding():
+                    continue
+                if attempt == self.lock_retries:
+                    raise
+                time.sleep(self.retry_delay * 2 ** attempt)
+                attempt += 1
+
+    def _commit(self, batch):
+        #   Take the fields of queued updates now, a later update of the same id queues again
+        with self._updates_lock:
+            batch = [(op, self._updates.pop(arg)) if op == FTS_UPDATE else (op, arg) for op, arg in batch]
+        try:
+            writer = self._get_writer()
+        except Exception as e:
+            self._fail(e)
+            return
+        try:
+            added = []
+            for op, arg in batch:
+                if op == FTS_ADD:
+                    #   Adds replace a document with the same id, so a write that waited out an index
+                    #   rebuild which already picked the document up doesn't index it twice
+                    if arg.get('id') is not None:
+                        writer.delete_by_term('id', arg['id'])
+                    added.append(arg)
+                else:
+                    #   Deletes only reach committed segments, so drop documents added earlier in the batch too
+                    id = arg['id'] if op == FTS_UPDATE else arg
+                    added = [fields for fields in added if fields.get('id') != id]
+                    writer.delete_by_term('id', id)
+                    if op == FTS_UPDATE:
+                        added.append(arg)
+            for fields in added:
+                #   A bad document is left out rather than failing the rest of the batch
+                try:
+                    writer.add_document(**fields)
+                except Exception as e:
+                    self.skipped += 1
+                    self._fail(e)
+            writer.commit()
+        except Exception as e:
+            writer.cancel()
+            self._fail(e)
+        else:
+            self.commits += 1
+            self.documents += len(batch)
+
+
+class FlushRequest(object):
+
+    def __init__(self):
+        self._done = threading.Event()
+        self.succeeded = None
+
+    def set(self, succeeded):
+        self.succeeded = succeeded
+        self._done.set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout) and self.succeeded
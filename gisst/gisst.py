@@ -5,14 +5,13 @@ import json
 import pprint
 import shutil
 import subprocess
-from whoosh.index import open_dir
+from whoosh.index import LockError
 from math import ceil
 from database import DatabaseManager as dbm
 from database import (
     LOCAL_CITATION_DATA_STORE,
     LOCAL_GAME_DATA_STORE,
-    LOCAL_DATA_ROOT,
-    LOCAL_FTS_INDEX
+    LOCAL_DATA_ROOT
 )
 from utils import (
     coroutine,
@@ -39,6 +38,20 @@ from schema import (
     PERF_CITE_REF,
     STATE_CITE_REF
 )
+from render import (
+    render_gif,
+    render_clip,
+    render_batch,
+    get_gif_params,
+    get_clip_params,
+    derivative_cache,
+    RenderError
+)
+from search_service import (
+    search_records,
+    search_display,
+    search_locally_with_partial
+)
 from app import app
 
 __version__ = "0.1.0"
@@ -54,6 +67,8 @@ def cli(ctx, verbose, no_prompts):
     ctx.obj = dict()    # Context object that stores application state in dict, could make class at some point
     ctx.obj['VERBOSE'] = verbose
     ctx.obj['NO_PROMPTS'] = no_prompts
+    #   Commit queued full text index writes before exiting
+    ctx.call_on_close(stop_fts_writer)
 
     #   Check for ucon64
     try:
@@ -81,8 +96,14 @@ def cli(ctx, verbose, no_prompts):
 @cli.command(help='Run local access server for citations.')
 @click.option('--port', help='Specify port for server. (default={})'.format(8100), default=8100)
 @click.option('--host', help='Specify host address for server. (default={})'.format('127.0.0.1'), default='127.0.0.1')
-def serve(port, host):
-    app.run(port=port, debug=True, threaded=True, host=host)
+@click.option('--writer_thread', help='Queue database writes to a single group committing writer thread.', is_flag=True)
+def serve(port, host, writer_thread):
+    if writer_thread:
+        dbm.start_writer()
+    try:
+        app.run(port=port, debug=True, threaded=True, host=host)
+    finally:
+        dbm.stop_writer()
 
 @cli.command(help='Extract metadata from a compatible url.')
 @click.argument('uri')
@@ -321,7 +342,7 @@ def cite_game(ctx, file_path, directory, executable, url, title, partial, export
         if not alternate_citation:
             for fd in file_info:
                 fd['game_uuid'] = citation['uuid']
-                dbm.insert_into_table(dbm.GAME_FILE_PATH_TABLE, fd.keys(), fd.values())
+            dbm.bulk_insert(dbm.GAME_FILE_PATH_TABLE, file_info)
         else:
         #   Clean up extracted data if alternate citation found (only for prompts call)
             for fd in file_info:
@@ -477,8 +498,9 @@ def cite_performance(ctx, export, file_path, url, partial, schema_version):
 @click.option('--game_only', help='Limit search to game citations.', is_flag=True)
 @click.option('--perf_only', help='Limit search to performance citations.', is_flag=True)
 @click.option('--state_only', help='Limit search to state citations.', is_flag=True)
+@click.option('--display_only', help='Only return the display fields stored in the search index.', is_flag=True)
 @click.pass_context
-def search(ctx, partial_description, game_only, perf_only, state_only):
+def search(ctx, partial_description, game_only, perf_only, state_only, display_only):
     no_prompts = ctx.obj['NO_PROMPTS']
     opts = 0
     if state_only: opts += 1
@@ -490,19 +512,20 @@ def search(ctx, partial_description, game_only, perf_only, state_only):
         sys.exit(1)
 
     partial_dict = json.loads(partial_description)
-    #   For now we are assuming that we will not want to search the extracted data sets
     if game_only:
-        exclude_refs = ('performance', 'extracted', 'state')
+        search_type = GAME_CITE_REF
     elif perf_only:
-        exclude_refs = ('game', 'extracted', 'state')
+        search_type = PERF_CITE_REF
     elif state_only:
-        exclude_refs = ('game', 'extracted', 'performance')
+        search_type = STATE_CITE_REF
     else:
-        exclude_refs = ('extracted',)
-
-    results = search_locally_with_partial(partial_dict, exclude_ref_types=exclude_refs)
+        search_type = 'all'
 
-    results_dict = prep_search_results(results)
+    if display_only:
+        results_dict = search_display(partial_dict, search_type=search_type)
+        results = results_dict['games'] + results_dict['performances'] + results_dict['states']
+    else:
+        results, results_dict = search_records(partial_dict, search_type=search_type)
 
     if no_prompts:
         click.echo(json.dumps(results_dict))
@@ -511,7 +534,7 @@ def search(ctx, partial_description, game_only, perf_only, state_only):
             if click.confirm('No results found, search online sources for games?'):
                 citations = search_globally_with_game_partial(partial_dict)
                 results_dict = dict()
-                results_dict['games'] = [c.elements for c in citations]
+                results_dict['games'] = [c.to_json_dict() for c in citations]
                 results_dict['total_records_found'] = len(citations)
                 results_dict['total_game_records'] = len(citations)
                 click.echo(json.dumps(results_dict))
@@ -536,85 +559,88 @@ def gif_performance(ctx, uuid, start, end, regenerate):
 
     cond_print(verbose, "Found performance: {}, '{}'".format(uuid, perf['title']))
 
-    #   GIF creation
-    gif_source_path = "'{}/{}/{}'".format(os.path.abspath(LOCAL_CITATION_DATA_STORE),
-                                          perf['replay_source_file_ref'],
-                                          perf['replay_source_file_name'])
-    gif_abs_path = "{}/{}".format(os.path.abspath(LOCAL_CITATION_DATA_STORE),
-                                         perf['replay_source_file_ref'])
-    gif_palette_name = "{}_{}_{}_palette.png".format(uuid, start, end)
-    gif_file_name = "{}_{}_{}.gif".format(uuid, start, end)
-
-    #   All commands are just straight defaults for now, basic settings are:
-    #   FPS: 10
-    #   Height: 320
-    #   Width: Scale to height
-    ffmpeg_palette = '/usr/local/bin/ffmpeg -y -ss {} -t {} -i {} -vf fps=10,scale=320:-1:flags=lanczos,palettegen {}'.format(
-        start,
-        end - start,
-        gif_source_path,
-        "'{}/{}'".format(gif_abs_path, gif_palette_name)
-    )
-    ffmpeg_gif = '/usr/local/bin/ffmpeg -ss {} -t {} -i {} -i {} -filter_complex "fps=10,scale=320:-1:flags=lanczos[x];[x][1:v]paletteuse" {}'.format(
-        start,
-        end - start,
-        gif_source_path,
-        "'{}/{}'".format(gif_abs_path, gif_palette_name),
-        "'{}/{}'".format(gif_abs_path, gif_file_name)
-    )
-
-    #   Check if gif is already present, and remove if regenerate flag is set
-    if os.path.isdir(gif_abs_path) and regenerate:
-        cond_print(verbose, "--regenerate flag active, deleting previous gif information")
-        shutil.rmtree(gif_abs_path)
-    elif os.path.isdir(gif_abs_path):
+    if not regenerate and derivative_cache.get(get_gif_params(perf, start, end)):
         click.echo('Gif for that time index already present, please use --regenerate to override this message.')
         sys.exit(1)
 
-    #   Create gif directory
-    cond_print(verbose, "Creating gif directory at {}".format(gif_abs_path))
-    os.makedirs(gif_abs_path)
-
-    #   Run gif creation processes
-    cond_print(verbose, "Running gif creation processes...")
-    cond_print(verbose, "{}".format(ffmpeg_palette))
     try:
-        subprocess.check_call(ffmpeg_palette, shell=True)
-    except subprocess.CalledProcessError as e:
+        gif_file_ref = render_gif(perf, start, end, regenerate=regenerate,
+                                  log=lambda message: cond_print(verbose, message))
+    except RenderError as e:
         click.echo(e.message)
         sys.exit(1)
 
-    cond_print(verbose, "{}".format(ffmpeg_gif))
+    cond_print(verbose, "Success! Gif at {}".format(derivative_cache.get_path(gif_file_ref)))
+
+
+@cli.command(help='Export an mp4 clip from a performance citation without re-encoding.')
+@click.argument('uuid')
+@click.argument('start', type=int)
+@click.argument('end', type=int)
+@click.option('--regenerate', help='Force regeneration even if extract already present.', is_flag=True)
+@click.pass_context
+def clip_performance(ctx, uuid, start, end, regenerate):
+    verbose = ctx.obj['VERBOSE']
+    perf = dbm.retrieve_perf_ref(uuid)
+
+    if not perf:
+        click.echo('Invalid performance uuid: {}'.format(uuid))
+        sys.exit(1)
+
+    cond_print(verbose, "Found performance: {}, '{}'".format(uuid, perf['title']))
+
+    if not regenerate and derivative_cache.get(get_clip_params(perf, start, end)):
+        click.echo('Clip for that time index already present, please use --regenerate to override this message.')
+        sys.exit(1)
+
     try:
-        subprocess.check_call(ffmpeg_gif, shell=True)
-    except subprocess.CalledProcessError as e:
+        clip_file_ref = render_clip(perf, start, end, regenerate=regenerate,
+                                    log=lambda message: cond_print(verbose, message))
+    except RenderError as e:
         click.echo(e.message)
         sys.exit(1)
 
-    cond_print(verbose, "Success!")
+    cond_print(verbose, "Success! Clip at {}".format(derivative_cache.get_path(clip_file_ref)))
 
 
-def prep_search_results(results):
+def parse_time_range(time_range):
+    try:
+        start, end = [int(t) for t in time_range.split('-')]
+    except ValueError:
+        raise click.BadParameter('Time ranges look like START-END in seconds, e.g. 30-45, not {}'.format(time_range))
+    return start, end
 
-    def make_performance_package(performance):
-        pack = {}
-        game = dbm.retrieve_game_ref(performance['game_uuid'])
-        pack['game'] = game.elements if game else None
-        pack['performance'] = performance.elements
-        #   Last performance is current performance
-        pack['previous_performances'] = [i.elements for i in dbm.retrieve_performance_chain(performance['uuid'])[:-1]]
-        return pack
 
-    results_dict = dict()
-    results_dict['games'] = [c.elements for c in results if hasattr(c, 'ref_type') and c.ref_type == GAME_CITE_REF]
-    results_dict['performances'] = [p for p in map(make_performance_package,
-                                                   [x for x in results if hasattr(x, 'ref_type') and x.ref_type == PERF_CITE_REF])]
-    results_dict['states'] = [s for s in results if 'ref_type' in s and s['ref_type'] == STATE_CITE_REF]
-    results_dict['total_game_records'] = len(results_dict['games'])
-    results_dict['total_performance_records'] = len(results_dict['performances'])
-    results_dict['total_state_records'] = len(results_dict['states'])
-    results_dict['total_records'] = len(results)
-    return results_dict
+@cli.command(help='Create gifs or mp4 clips of several START-END time ranges (in seconds) of a performance citation.')
+@click.argument('uuid')
+@click.argument('time_ranges', nargs=-1, required=True)
+@click.option('--format', 'render_format', type=click.Choice(['gif', 'mp4']), default='gif', help='Make gifs or mp4 clips.')
+@click.option('--procs', type=int, help='Number of ffmpeg processes to run at once, defaults to the number of cores.')
+@click.option('--regenerate', help='Force regeneration even if extract already present.', is_flag=True)
+@click.pass_context
+def highlight_reel(ctx, uuid, time_ranges, render_format, procs, regenerate):
+    verbose = ctx.obj['VERBOSE']
+    ranges = [parse_time_range(r) for r in time_ranges]
+    perf = dbm.retrieve_perf_ref(uuid)
+
+    if not perf:
+        click.echo('Invalid performance uuid: {}'.format(uuid))
+        sys.exit(1)
+
+    cond_print(verbose, "Found performance: {}, '{}'".format(uuid, perf['title']))
+
+    try:
+        results = render_batch(perf, ranges, format=render_format, regenerate=regenerate, procs=procs,
+                               log=lambda message: cond_print(verbose, message))
+    except RenderError as e:
+        click.echo(e.message)
+        sys.exit(1)
+
+    for result in results:
+        result['path'] = derivative_cache.get_path(result['file_ref']) if result['file_ref'] else None
+    click.echo(json.dumps(results))
+    if any(result['error'] for result in results):
+        sys.exit(1)
 
 
 def get_citation_user_input(citation_object, extracted_options=None):
@@ -661,38 +687,6 @@ def search_locally_with_citation(citation):
     return result
 
 
-def search_locally_with_partial(partial, exclude_ref_types=None):
-    start_index = int(partial['start_index'])
-    limit = int(partial['limit']) if 'limit' in partial else None
-    #   Apparently Python DB API and Sqlite and commas (,), parans ((,)), and colons (:) do not play nice with FTS?
-    search_strings = u" ".join([unicode(v) for k, v in partial['description'].items()])
-    for ref_type in exclude_ref_types:
-        search_strings += u" AND NOT (tags:{})".format(ref_type)
-    uuids = dbm.retrieve_from_fts(search_strings, start_index=start_index, limit=limit)
-
-    def get_cite_for_uuid(result):
-        ref_type = result['tags']
-        uuid = result['uuid']
-        if ref_type == GAME_CITE_REF:
-            table = dbm.GAME_CITATION_TABLE
-        if ref_type == PERF_CITE_REF:
-            table = dbm.PERFORMANCE_CITATION_TABLE
-        if ref_type == STATE_CITE_REF:
-            table = dbm.GAME_SAVE_TABLE
-
-        if ref_type in (GAME_CITE_REF, PERF_CITE_REF):
-            db_values = dbm.retrieve_attr_from_db('uuid', uuid, table, limit=1)[0]
-            citation = dbm.create_cite_ref_from_db(ref_type, db_values)
-        else:
-            citation = dbm.retrieve_save_state(uuid=uuid)[0]
-            citation['ref_type'] = STATE_CITE_REF
-        return citation
-
-    # Results should already be sorted by rank
-    citations = map(get_cite_for_uuid, uuids)
-    return citations
-
-
 def search_locally_with_game_partial(game_partial):
     return search_locally_with_partial(game_partial, exclude_ref_types=(PERF_CITE_REF, 'extracted', 'state', 'battery'))
 
@@ -804,6 +798,11 @@ def choose_citation(citations, cite_fields=None):
     return None
 
 
+def stop_fts_writer():
+    if not dbm.stop_fts_writer():
+        click.echo('WARNING: Some full text index writes failed, run "gisst reindex" to rebuild the index.', err=True)
+
+
 def cond_print(condition, message):
     if condition:
         click.echo(message)
@@ -888,65 +887,79 @@ def delete(ctx, uuid, keep_performances):
         except OSError as e:
             print e.message
 
-    def delete_from_fts(uuid):
-        ix = open_dir(LOCAL_FTS_INDEX)
-        writer = ix.writer()
-        writer.delete_by_term('id', uuid)
-        writer.commit()
-
     game_ref = dbm.retrieve_game_ref(uuid)
     perf_ref = dbm.retrieve_perf_ref(uuid)
     state_ref = dbm.retrieve_save_state(uuid=uuid)
-    if game_ref:
-        perfs = dbm.retrieve_derived_performances(uuid)
-        states = dbm.retrieve_save_state(game_uuid=uuid)
-        files = dbm.retrieve_file_path(game_uuid=uuid)
-
-        for f in files:
-                check_delete(os.path.join(LOCAL_DATA_ROOT, LOCAL_GAME_DATA_STORE, f['source_data']))
-        dbm.delete_from_table(dbm.GAME_FILE_PATH_TABLE, ['game_uuid'], [uuid])
-
-        for s in states:
-            if s['save_state_source_data']:
-                check_delete(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, s['save_state_source_data']))
-            else:
-                if s['rl_starts_data']:
-                    check_delete(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, s['rl_starts_data']))
-                    check_delete(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, s['rl_lengths_data']))
-            if s['has_screen']:
-                check_delete(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, s['uuid']))
-        dbm.delete_from_table(dbm.GAME_SAVE_TABLE, ['game_uuid'], [uuid])
-
-        for p in perfs:
-            if p['replay_source_file_ref']:
-                check_delete(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, p['replay_source_file_ref']))
-            dbm.delete_from_table(dbm.SAVE_STATE_PERFORMANCE_LINK_TABLE,['performance_uuid'], [p['uuid']])
-        dbm.delete_from_table(dbm.PERFORMANCE_CITATION_TABLE, ['game_uuid'], [uuid])
-
-        if game_ref['source_data']:
-            check_delete(os.path.join(LOCAL_DATA_ROOT, LOCAL_GAME_DATA_STORE, game_ref['source_data']))
-
-        dbm.delete_from_table(dbm.GAME_CITATION_TABLE, ['uuid'], [uuid])
-        delete_from_fts(uuid)
-    elif perf_ref:
-        dbm.delete_from_table(dbm.SAVE_STATE_PERFORMANCE_LINK_TABLE,['performance_uuid'], [uuid])
-        if perf_ref['replay_source_file_ref']:
-            check_delete(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, perf_ref['replay_source_file_ref']))
-        dbm.delete_from_table(dbm.PERFORMANCE_CITATION_TABLE, ['uuid'], [uuid])
-        delete_from_fts(uuid)
-    elif state_ref:
-        state_ref = state_ref[0] # retrieve states returns lists
-        files = dbm.retrieve_file_path(save_state_uuid=uuid)
-        for f in files:
-            check_delete(os.path.join(LOCAL_DATA_ROOT, LOCAL_GAME_DATA_STORE, f['source_data']))
-        dbm.delete_from_table(dbm.SAVE_STATE_PERFORMANCE_LINK_TABLE,['save_state_uuid'], [uuid])
-        if state_ref['has_screen']:
-            check_delete(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, state_ref['uuid']))
-        dbm.delete_from_table(dbm.GAME_SAVE_TABLE, ['uuid'], [uuid])
-        delete_from_fts(uuid)
-    else:
-        click.echo('UUID {} not found.'.format(uuid))
+    #   Database deletes commit once at the end. Files and the search index entry are only removed
+    #   after that, so a rolled back delete doesn't leave rows pointing at missing files.
+    paths = []
+    with dbm.transaction():
+        if game_ref:
+            perfs = dbm.retrieve_derived_performances(uuid)
+            states = dbm.retrieve_save_state(game_uuid=uuid)
+            files = dbm.retrieve_file_path(game_uuid=uuid)
+
+            for f in files:
+                    paths.append(os.path.join(LOCAL_DATA_ROOT, LOCAL_GAME_DATA_STORE, f['source_data']))
+            dbm.delete_from_table(dbm.GAME_FILE_PATH_TABLE, ['game_uuid'], [uuid])
+
+            for s in states:
+                if s['save_state_source_data']:
+                    paths.append(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, s['save_state_source_data']))
+                else:
+                    if s['rl_starts_data']:
+                        paths.append(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, s['rl_starts_data']))
+                        paths.append(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, s['rl_lengths_data']))
+                if s['has_screen']:
+                    paths.append(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, s['uuid']))
+            dbm.delete_from_table(dbm.GAME_SAVE_TABLE, ['game_uuid'], [uuid])
+
+            for p in perfs:
+                if p['replay_source_file_ref']:
+                    paths.append(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, p['replay_source_file_ref']))
+                dbm.delete_from_table(dbm.SAVE_STATE_PERFORMANCE_LINK_TABLE,['performance_uuid'], [p['uuid']])
+            dbm.delete_from_table(dbm.PERFORMANCE_CITATION_TABLE, ['game_uuid'], [uuid])
+
+            if game_ref['source_data']:
+                paths.append(os.path.join(LOCAL_DATA_ROOT, LOCAL_GAME_DATA_STORE, game_ref['source_data']))
+
+            dbm.delete_from_table(dbm.GAME_CITATION_TABLE, ['uuid'], [uuid])
+        elif perf_ref:
+            dbm.delete_from_table(dbm.SAVE_STATE_PERFORMANCE_LINK_TABLE,['performance_uuid'], [uuid])
+            if perf_ref['replay_source_file_ref']:
+                paths.append(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, perf_ref['replay_source_file_ref']))
+            dbm.delete_from_table(dbm.PERFORMANCE_CITATION_TABLE, ['uuid'], [uuid])
+        elif state_ref:
+            state_ref = state_ref[0] # retrieve states returns lists
+            files = dbm.retrieve_file_path(save_state_uuid=uuid)
+            for f in files:
+                paths.append(os.path.join(LOCAL_DATA_ROOT, LOCAL_GAME_DATA_STORE, f['source_data']))
+            dbm.delete_from_table(dbm.SAVE_STATE_PERFORMANCE_LINK_TABLE,['save_state_uuid'], [uuid])
+            if state_ref['has_screen']:
+                paths.append(os.path.join(LOCAL_DATA_ROOT, LOCAL_CITATION_DATA_STORE, state_ref['uuid']))
+            dbm.delete_from_table(dbm.GAME_SAVE_TABLE, ['uuid'], [uuid])
+        else:
+            click.echo('UUID {} not found.'.format(uuid))
+            sys.exit(1)
+
+    for path in paths:
+        check_delete(path)
+    dbm.delete_from_fts(uuid)
+
+
+@cli.command(help='Rebuild the full text search index from the database.')
+@click.option('--procs', type=int, default=None, help='Number of indexing processes (default=all cores).')
+@click.option('--page_size', type=int, default=1000, help='Number of rows read from the database at a time.')
+@click.pass_context
+def reindex(ctx, procs, page_size):
+    verbose = ctx.obj['VERBOSE']
+    cond_print(verbose, 'Rebuilding full text search index...')
+    try:
+        count = dbm.rebuild_fts(procs=procs, page_size=page_size)
+    except LockError as e:
+        click.echo(e.message)
         sys.exit(1)
+    click.echo('Indexed {} records.'.format(count))
 
 
 @cli.command(help='Clear local data')
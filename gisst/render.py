@@ -0,0 +1,202 @@
+__author__ = 'erickaltman'
+
+#   GIF and clip rendering from performance videos with ffmpeg. Shared by the gif_performance and
+#   clip_performance commands and the web app's render jobs, so none of them start another gisst
+#   process to render. Renders go to the derivative cache rather than next to the performance video.
+
+import os
+import subprocess
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from database import LOCAL_CITATION_DATA_STORE, LOCAL_DERIVATIVE_CACHE
+from derivative_cache import DerivativeCache
+
+FFMPEG_PATH = '/usr/local/bin/ffmpeg'
+#   Default GIF settings, frames per second and width in pixels (height scales to match)
+GIF_FPS = 10
+GIF_WIDTH = 320
+#   Batch ranges closer than this many seconds are decoded in the same pass
+BATCH_MAX_GAP = 30
+DERIVATIVE_CACHE_MAX_SIZE = int(os.environ.get('GISST_DERIVATIVE_CACHE_MAX_SIZE', 2 * 1024 ** 3))
+
+derivative_cache = DerivativeCache(LOCAL_DERIVATIVE_CACHE, max_size=DERIVATIVE_CACHE_MAX_SIZE)
+
+
+class RenderError(BaseException):
+    pass
+
+
+#   Cache parameters for a GIF of seconds 'start' to 'end' of a performance video
+def get_gif_params(perf, start, end, fps=GIF_FPS, width=GIF_WIDTH):
+    return dict(source_hash=perf['replay_source_file_ref'], start=start, end=end, fps=fps, width=width, format='gif')
+
+
+#   Clips keep the video's own frame rate and size
+def get_clip_params(perf, start, end):
+    return dict(source_hash=perf['replay_source_file_ref'], start=start, end=end, fps=None, width=None, format='mp4')
+
+
+def get_source_path(perf):
+    return os.path.join(os.path.abspath(LOCAL_CITATION_DATA_STORE),
+                        perf['replay_source_file_ref'],
+                        perf['replay_source_file_name'])
+
+
+#   Seeking before the input (-ss ahead of -i) jumps to the nearest keyframe instead of decoding
+#   from the start of the video
+def get_input_args(perf, start, end):
+    return ['-ss', str(start), '-t', str(end - start), '-i', get_source_path(perf)]
+
+
+#   One filter graph makes the palette and applies it, so the segment is decoded once
+def get_gif_filter(fps=GIF_FPS, width=GIF_WIDTH):
+    return 'fps={},scale={}:-1:flags=lanczos,split[x][y];[x]palettegen[p];[y][p]paletteuse'.format(fps, width)
+
+
+#   GIFs of several ranges from one decoded input that starts at 'offset' seconds. The frames are
+#   scaled once and split between the ranges, output i is labelled [o<i>].
+def get_batch_gif_filter(ranges, offset, fps=GIF_FPS, width=GIF_WIDTH):
+    graph = ['[0:v]fps={},scale={}:-1:flags=lanczos,split={}{}'.format(
+        fps, width, len(ranges), ''.join('[s{}]'.format(i) for i in range(len(ranges))))]
+    for i, (start, end) in enumerate(ranges):
+        graph.append('[s{0}]trim=start={1}:end={2},setpts=PTS-STARTPTS,split[x{0}][y{0}];'
+                     '[x{0}]palettegen[p{0}];[y{0}][p{0}]paletteuse[o{0}]'.format(i, start - offset, end - offset))
+    return ';'.join(graph)
+
+
+#   Sorted ranges grouped so that each group is one stretch of video to decode
+def group_ranges(ranges, max_gap=BATCH_MAX_GAP):
+    groups = []
+    for start, end in sorted(ranges):
+        if groups and start - groups[-1]['end'] <= max_gap:
+            groups[-1]['ranges'].append((start, end))
+            groups[-1]['end'] = max(groups[-1]['end'], end)
+        else:
+            groups.append(dict(start=start, end=end, ranges=[(start, end)]))
+    return groups
+
+
+def run_ffmpeg(args, log):
+    command = [FFMPEG_PATH, '-y', '-loglevel', 'error'] + args
+    log(" ".join(command))
+    try:
+        subprocess.check_call(command)
+    except (subprocess.CalledProcessError, OSError) as e:
+        raise RenderError('ffmpeg failed: {}'.format(e))
+
+
+def check_render(perf, start, end):
+    if not perf['replay_source_file_ref'] or not perf['replay_source_file_name']:
+        raise RenderError('Performance {} has no video to render from.'.format(perf['uuid']))
+    if start < 0:
+        raise RenderError('A render can\'t start before the video does.')
+    if end <= start:
+        raise RenderError('End of a render must come after its start.')
+
+
+#   Renders 'params' into the derivative cache with render(output_path) and returns its file
+#   reference there. A cached file is reused unless 'regenerate' is set.
+def render_cached(params, render, regenerate=False, log=None, cache=None):
+    log = log or (lambda message: None)
+    cache = cache or derivative_cache
+    if regenerate:
+        log("Regenerating, deleting previous {}".format(params['format']))
+        cache.discard(params)
+    return cache.get_or_render(params, render)
+
+
+#   GIF of seconds 'start' to 'end' of a performance video
+def render_gif(perf, start, end, fps=GIF_FPS, width=GIF_WIDTH, regenerate=False, log=None, cache=None):
+    check_render(perf, start, end)
+    log = log or (lambda message: None)
+
+    def render(gif_path):
+        log("Running gif creation process...")
+        run_ffmpeg(get_input_args(perf, start, end) + ['-filter_complex', get_gif_filter(fps, width), gif_path], log)
+
+    return render_cached(get_gif_params(perf, start, end, fps, width), render, regenerate, log, cache)
+
+
+#   MP4 clip of seconds 'start' to 'end' of a performance video. The streams are copied rather
+#   than encoded again, so the clip starts at the keyframe at or before 'start'.
+def render_clip(perf, start, end, regenerate=False, log=None, cache=None):
+    check_render(perf, start, end)
+    log = log or (lambda message: None)
+
+    def render(clip_path):
+        log("Running clip export process...")
+        run_ffmpeg(get_input_args(perf, start, end) +
+                   ['-c', 'copy', '-avoid_negative_ts', 'make_zero', '-movflags', '+faststart', clip_path], log)
+
+    return render_cached(get_clip_params(perf, start, end), render, regenerate, log, cache)
+
+
+#   Renders a GIF or MP4 clip ('format') for each (start, end) range of a performance video.
+#   GIF ranges near each other are decoded in one pass and split between their outputs, clips
+#   are stream copies, and separate passes run in parallel up to the number of cores. Returns a
+#   dict per range, in order, with its file reference in the derivative cache or an error.
+def render_batch(perf, ranges, format='gif', fps=GIF_FPS, width=GIF_WIDTH, regenerate=False, log=None,
+                 cache=None, procs=None):
+    log = log or (lambda message: None)
+    cache = cache or derivative_cache
+    ranges = [(int(start), int(end)) for start, end in ranges]
+    for start, end in ranges:
+        check_render(perf, start, end)
+
+    if format == 'gif':
+        get_params = lambda start, end: get_gif_params(perf, start, end, fps, width)
+    elif format == 'mp4':
+        get_params = lambda start, end: get_clip_params(perf, start, end)
+    else:
+        raise RenderError('Unknown render format: {}'.format(format))
+
+    results = {}
+    missing = []
+    for start, end in set(ranges):
+        params = get_params(start, end)
+        if regenerate:
+            cache.discard(params)
+        file_ref = cache.get(params)
+        if file_ref:
+            results[(start, end)] = dict(start=start, end=end, file_ref=file_ref, error=None)
+        else:
+            missing.append((start, end))
+
+    if format == 'gif':
+        passes = [group['ranges'] for group in group_ranges(missing)]
+    else:
+        passes = [[r] for r in missing]
+
+    def run_pass(pass_ranges):
+        temp_paths = [cache.get_temp_path(get_params(start, end)) for start, end in pass_ranges]
+        offset = min(start for start, _ in pass_ranges)
+        args = get_input_args(perf, offset, max(end for _, end in pass_ranges))
+        if format == 'gif':
+            args += ['-filter_complex', get_batch_gif_filter(pass_ranges, offset, fps, width)]
+            for i, temp_path in enumerate(temp_paths):
+                args += ['-map', '[o{}]'.format(i), temp_path]
+        else:
+            args += ['-c', 'copy', '-avoid_negative_ts', 'make_zero', '-movflags', '+faststart', temp_paths[0]]
+        try:
+            run_ffmpeg(args, log)
+            file_refs = [cache.store(get_params(start, end), temp_path)
+                         for (start, end), temp_path in zip(pass_ranges, temp_paths)]
+        except (RenderError, OSError) as e:
+            for temp_path in temp_paths:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            return [dict(start=start, end=end, file_ref=None, error=str(e)) for start, end in pass_ranges]
+        return [dict(start=start, end=end, file_ref=file_ref, error=None)
+                for (start, end), file_ref in zip(pass_ranges, file_refs)]
+
+    if passes:
+        log("Rendering {} {} ranges in {} passes...".format(len(missing), format, len(passes)))
+        pool = ThreadPool(min(len(passes), procs or cpu_count()))
+        try:
+            for pass_results in pool.map(run_pass, passes):
+                results.update(((r['start'], r['end']), r) for r in pass_results)
+        finally:
+            pool.close()
+            pool.join()
+
+    return [results[r] for r in ranges]
@@ -0,0 +1,134 @@
+__author__ = 'erickaltman'
+
+#   Background render jobs for the web app. A render takes far longer than a request should, so
+#   requests only submit a job and poll its status while a fixed number of worker threads run the
+#   renders, which keeps concurrent renders from overloading the machine. A job submitted while
+#   an identical one is queued or running is collapsed onto that job.
+
+import time
+import uuid
+import threading
+import Queue
+from collections import OrderedDict
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+class RenderJob(object):
+
+    def __init__(self, key, function, args, kwargs):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.status = JOB_QUEUED
+        self.result = None
+        self.error = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._done = threading.Event()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def to_json_dict(self):
+        return dict(id=self.id, status=self.status, result=self.result, error=self.error,
+                    submitted=self.submitted, started=self.started, finished=self.finished)
+
+
+class RenderJobQueue(object):
+
+    #   Finished jobs are kept for status polling, up to 'max_finished' of the most recent
+    def __init__(self, workers=2, max_finished=256):
+        self.workers = workers
+        self.max_finished = max_finished
+        self.queue = Queue.Queue()
+        self.jobs = OrderedDict()
+        self._active = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self.submitted = 0
+        self.collapsed = 0
+        self.completed = 0
+        self.failures = 0
+
+    #   Queues function(*args, **kwargs) unless a job with the same key is queued or running
+    def submit(self, key, function, *args, **kwargs):
+        with self._lock:
+            job = self._active.get(key)
+            if job is not None:
+                self.collapsed += 1
+                return job
+            job = RenderJob(key, function, args, kwargs)
+            self._active[key] = job
+            self.jobs[job.id] = job
+            self.submitted += 1
+            #   Workers start with the first job, so importing the app doesn't start threads
+            if not self._threads:
+                self._start_workers()
+        self.queue.put(job)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def backlog(self):
+        return self.queue.qsize()
+
+    def stop(self):
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        with self._lock:
+            running = len([j for j in self._active.values() if j.status == JOB_RUNNING])
+        return dict(backlog=self.backlog(), running=running, workers=self.workers, submitted=self.submitted,
+                    collapsed=self.collapsed, completed=self.completed, failures=self.failures)
+
+    def _start_workers(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name='gisst-render-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            job.status = JOB_RUNNING
+            job.started = time.time()
+            try:
+                job.result = job.function(*job.args, **job.kwargs)
+            #   Render errors derive from BaseException like the other errors in gisst
+            except BaseException as e:
+                job.error = str(e)
+                job.status = JOB_FAILED
+            else:
+                job.status = JOB_DONE
+            job.finished = time.time()
+            self._finish(job)
+            job._done.set()
+
+    def _finish(self, job):
+        with self._lock:
+            del self._active[job.key]
+            if job.status == JOB_DONE:
+                self.completed += 1
+            else:
+                self.failures += 1
+            finished = [j for j in self.jobs.values() if j.done()]
+            for old_job in finished[:max(0, len(finished) + 1 - self.max_finished)]:
+                del self.jobs[old_job.id]
@@ -16,9 +16,11 @@ __author__ = 'erickaltman'
 
 import uuid
 import json
+import hashlib
 import datetime
 import pprint
 from collections import OrderedDict
+from itertools import izip
 
 GAME_CITE_REF = u'game'
 PERF_CITE_REF = u'performance'
@@ -92,71 +94,128 @@ PERFORMANCE_SCHEMA = {
 }
 
 
-# Citation reference wrapper class
+# Citation reference wrapper class. Each schema version is compiled once into a slotted
+# subclass (see compile_cite_ref), so element names, defaults and required elements are
+# class level tuples and an instance only holds its element values in schema order.
 class CiteRef(object):
-
-    def __init__(self, schema, schema_version, ref_type, **kwargs):
-        self.elements = OrderedDict((e, i.get('default', None)) for e, i in schema['elements'])
-        self.schema = schema
-        self.ref_type = ref_type
-        self.schema_version = schema_version
-
+    __slots__ = ('_values',)
+    schema = None
+    schema_version = None
+    ref_type = None
+    element_names = ()
+    element_index = {}
+    element_defaults = ()
+    required_elements = ()
+
+    def __init__(self, **kwargs):
+        self._values = list(self.element_defaults)
+        index = self.element_index
         for key in kwargs:
-            if key in self.elements:
-                self.elements[key] = kwargs[key]
+            if key in index:
+                self._values[index[key]] = kwargs[key]
 
         if not self['uuid']:
             self['uuid'] = str(uuid.uuid4())
 
+    #   Snapshot of the elements in schema order, assign through cite_ref[key] to change values
+    @property
+    def elements(self):
+        return OrderedDict(izip(self.element_names, self._values))
+
+    @elements.setter
+    def elements(self, elements):
+        index = self.element_index
+        for key, value in elements.items():
+            if key in index:
+                self._values[index[key]] = value
+
     def get_required_elements(self):
-        return tuple([e for e, info in self.schema['elements'] if info['required']])
+        return self.required_elements
 
     def get_missing_elements(self):
-        return tuple([e for e, value in self.elements.items() if not value])
+        return tuple([e for e, value in izip(self.element_names, self._values) if not value])
 
     def get_element_names(self, exclude=None):
         if exclude:
-            return tuple([e for e in self.elements.keys() if e not in exclude])
-        return tuple([e for e in self.elements.keys()])
+            return tuple([e for e in self.element_names if e not in exclude])
+        return self.element_names
 
     def get_element_values(self, exclude=None):
         if exclude:
-            return tuple([v for e, v in self.elements.items() if e not in exclude])
-        return tuple([v for v in self.elements.values()])
+            return tuple([v for e, v in izip(self.element_names, self._values) if e not in exclude])
+        return tuple(self._values)
 
     def get_element_items(self, exclude=None):
         if exclude:
-            return zip(self.get_element_names(exclude), self.get_element_values(exclude))
-        return self.elements.items()
+            return [(e, v) for e, v in izip(self.element_names, self._values) if e not in exclude]
+        return zip(self.element_names, self._values)
+
+    def items(self):
+        return zip(self.element_names, self._values)
+
+    # Canonical hash of every element except uuid, used for duplicate detection. Blank values
+    # count as missing and everything else is compared as text, like the values stored in the db
+    def get_content_hash(self):
+        canonical = sorted((e, unicode(v) if v else None) for e, v in izip(self.element_names, self._values)
+                           if e != 'uuid')
+        return hashlib.sha1(json.dumps(canonical, ensure_ascii=True)).hexdigest()
+
+    # Copy with its own values, so cached citations can be handed out safely
+    def copy(self):
+        cite_copy = self.__class__.__new__(self.__class__)
+        cite_copy._values = list(self._values)
+        return cite_copy
+
+    #   Elements as a plain dict, datetimes converted to strings for json encoding
+    def to_json_dict(self):
+        return dict(izip(self.element_names, [v.isoformat() if isinstance(v, datetime.datetime) else v
+                                              for v in self._values]))
 
     def to_json_string(self):
-        #   Convert datetimes to strings for json encoding
-        json_dict = dict(map(lambda x: (x[0], x[1].isoformat()) if isinstance(x[1], datetime.datetime) else (x[0], x[1]),
-                        self.elements.items()))
-        return unicode(json.dumps(json_dict))
+        return unicode(json.dumps(self.to_json_dict()))
 
     def to_pretty_string(self):
-        return u"\n".join([u"{} : {}".format(e, v) for e, v in self.elements.items()])
+        return u"\n".join([u"{} : {}".format(e, v) for e, v in izip(self.element_names, self._values)])
 
     def __repr__(self):
         return str(self.elements)
 
     def __getitem__(self, key):
-        return self.elements[key]
+        return self._values[self.element_index[key]]
 
     def __setitem__(self, key, value):
-        if key in self.elements:
-            self.elements[key] = value
+        if key in self.element_index:
+            self._values[self.element_index[key]] = value
         else:
-            raise KeyError('{} not found in cite reference elements.')
+            raise KeyError('{} not found in cite reference elements.'.format(key))
 
     def __contains__(self, item):
-        return True if item in self.elements.keys() else False
+        return item in self.element_index
+
+
+def compile_cite_ref(ref_type, schema, schema_version):
+    element_names = tuple([e for e, _ in schema['elements']])
+    class_name = '{}CiteRef_{}'.format(ref_type.capitalize(), schema_version.replace('.', '_'))
+    return type(str(class_name), (CiteRef,), {
+        '__slots__': (),
+        'schema': schema,
+        'schema_version': schema_version,
+        'ref_type': ref_type,
+        'element_names': element_names,
+        'element_index': dict((e, i) for i, e in enumerate(element_names)),
+        'element_defaults': tuple([info.get('default', None) for _, info in schema['elements']]),
+        'required_elements': tuple([e for e, info in schema['elements'] if info['required']])
+    })
+
+
+CITE_REF_CLASSES = dict(
+    [((GAME_CITE_REF, v), compile_cite_ref(GAME_CITE_REF, s, v)) for v, s in GAME_SCHEMA['version'].items()] +
+    [((PERF_CITE_REF, v), compile_cite_ref(PERF_CITE_REF, s, v)) for v, s in PERFORMANCE_SCHEMA['version'].items()]
+)
 
 
 # Citation factory method
 def generate_cite_ref(ref_type, schema_version, **kwargs):
-    ref_select = dict([(GAME_CITE_REF, GAME_SCHEMA), (PERF_CITE_REF, PERFORMANCE_SCHEMA)])
     if ref_type == GAME_CITE_REF:
         if schema_version not in get_game_cite_versions():
             raise SchemaError('There is no game citation with that version number.')
@@ -164,10 +223,12 @@ def generate_cite_ref(ref_type, schema_version, **kwargs):
         if schema_version not in get_perm_cite_versions():
             raise SchemaError('There is no performance citation with that version number.')
 
-    if 'schema_version' in kwargs:
-        return CiteRef(ref_select[ref_type]['version'][schema_version], ref_type=ref_type, **kwargs)
-    else:
-        return CiteRef(ref_select[ref_type]['version'][schema_version], schema_version, ref_type, **kwargs)
+    return CITE_REF_CLASSES[(ref_type, schema_version)](**kwargs)
+
+
+# Serialize a list of citations in one go, e.g. for json responses with many results
+def to_json(cite_refs):
+    return unicode(json.dumps([c.to_json_dict() for c in cite_refs]))
 
 
 # Citation Utilities
@@ -182,6 +243,6 @@ def get_perm_cite_versions():
 def print_cite_ref(cite_ref):
     print_message = "Current {} Info\n: Cite Version: {}".format(cite_ref.ref_type, cite_ref.version)
     for element, _ in cite_ref.schema['elements']:  # using schema here to always print in same order
-        print_message += "{} : {} \n".format(element, cite_ref.elements[element])
+        print_message += "{} : {} \n".format(element, cite_ref[element])
     return print_message
 
@@ -0,0 +1,122 @@
+__author__ = 'erickaltman'
+
+#   Local search shared by the search command and the web app's search page. Both run it in
+#   process, so a search costs an index lookup rather than starting another gisst process.
+
+from database import DatabaseManager as dbm
+from schema import (
+    GAME_CITE_REF,
+    PERF_CITE_REF,
+    STATE_CITE_REF
+)
+
+#   Record types left out of a search by search type, extracted data sets are never searched
+SEARCH_TYPE_EXCLUDES = {
+    'all': ('extracted',),
+    GAME_CITE_REF: (PERF_CITE_REF, 'extracted', STATE_CITE_REF),
+    PERF_CITE_REF: (GAME_CITE_REF, 'extracted', STATE_CITE_REF),
+    STATE_CITE_REF: (GAME_CITE_REF, 'extracted', PERF_CITE_REF)
+}
+
+
+def get_exclude_ref_types(search_type=None):
+    return SEARCH_TYPE_EXCLUDES.get(search_type or 'all', SEARCH_TYPE_EXCLUDES['all'])
+
+
+def get_search_string(partial, exclude_ref_types=None):
+    #   Apparently Python DB API and Sqlite and commas (,), parans ((,)), and colons (:) do not play nice with FTS?
+    search_strings = u" ".join([unicode(v) for k, v in partial['description'].items()])
+    for ref_type in exclude_ref_types or ():
+        search_strings += u" AND NOT (tags:{})".format(ref_type)
+    return search_strings
+
+
+#   Records are read from the database with one batched query per type
+def search_locally_with_partial(partial, exclude_ref_types=None):
+    start_index = int(partial['start_index'])
+    limit = int(partial['limit']) if 'limit' in partial else None
+    hits = dbm.retrieve_from_fts(get_search_string(partial, exclude_ref_types), start_index=start_index, limit=limit)
+
+    uuids_by_type = dict((ref_type, []) for ref_type in (GAME_CITE_REF, PERF_CITE_REF, STATE_CITE_REF))
+    for hit in hits:
+        if hit['tags'] in uuids_by_type:
+            uuids_by_type[hit['tags']].append(hit['uuid'])
+
+    records = dict()
+    for ref_type in (GAME_CITE_REF, PERF_CITE_REF):
+        records.update((c['uuid'], c) for c in dbm.retrieve_cite_refs(ref_type, uuids_by_type[ref_type]))
+    for state in dbm.retrieve_save_states(uuids_by_type[STATE_CITE_REF]):
+        citation = state._asdict()
+        citation['ref_type'] = STATE_CITE_REF
+        records[citation['uuid']] = citation
+
+    # Results should already be sorted by rank
+    citations = [records[hit['uuid']] for hit in hits if hit['uuid'] in records]
+    return citations
+
+
+#   One page of hits with only the display fields stored in the search index, plus total and facet
+#   counts. Pages are set by 'page' (from 1) and 'page_length' in the partial.
+def search_page_with_partial(partial, exclude_ref_types=None):
+    results_page = dbm.search_fts_page(get_search_string(partial, exclude_ref_types),
+                                       page=int(partial.get('page', 1)),
+                                       page_length=int(partial.get('page_length', 20)),
+                                       stored_fields=True)
+    for hit in results_page['hits']:
+        hit['ref_type'] = hit.pop('tags')
+        hit.pop('id', None)
+    return results_page
+
+
+#   A page of search index hits grouped like prep_search_results, without the performance packages.
+#   Record totals are the facet counts over all hits, not just the page.
+def prep_display_results(results_page):
+    hits = results_page['hits']
+    type_counts = results_page['facets'].get('tags', {})
+    results_dict = dict()
+    for key, ref_type in (('games', GAME_CITE_REF), ('performances', PERF_CITE_REF), ('states', STATE_CITE_REF)):
+        results_dict[key] = [h for h in hits if h['ref_type'] == ref_type]
+    results_dict['total_game_records'] = type_counts.get(GAME_CITE_REF, 0)
+    results_dict['total_performance_records'] = type_counts.get(PERF_CITE_REF, 0)
+    results_dict['total_state_records'] = type_counts.get(STATE_CITE_REF, 0)
+    results_dict['total_records'] = results_page['total']
+    results_dict['page'] = results_page['page']
+    results_dict['page_count'] = results_page['page_count']
+    results_dict['facets'] = results_page['facets']
+    return results_dict
+
+
+def prep_search_results(results):
+    performances = [x for x in results if hasattr(x, 'ref_type') and x.ref_type == PERF_CITE_REF]
+    games = dict((g['uuid'], g) for g in dbm.retrieve_cite_refs(GAME_CITE_REF, set(p['game_uuid'] for p in performances)))
+
+    def make_performance_package(performance):
+        pack = {}
+        game = games.get(performance['game_uuid'])
+        pack['game'] = game.to_json_dict() if game else None
+        pack['performance'] = performance.to_json_dict()
+        #   Last performance is current performance
+        pack['previous_performances'] = [i.to_json_dict() for i in dbm.retrieve_performance_chain(performance['uuid'],
+                                         columns=dbm.list_columns[dbm.PERFORMANCE_CITATION_TABLE])[:-1]]
+        return pack
+
+    results_dict = dict()
+    results_dict['games'] = [c.to_json_dict() for c in results if hasattr(c, 'ref_type') and c.ref_type == GAME_CITE_REF]
+    results_dict['performances'] = map(make_performance_package, performances)
+    results_dict['states'] = [s for s in results if 'ref_type' in s and s['ref_type'] == STATE_CITE_REF]
+    results_dict['total_game_records'] = len(results_dict['games'])
+    results_dict['total_performance_records'] = len(results_dict['performances'])
+    results_dict['total_state_records'] = len(results_dict['states'])
+    results_dict['total_records'] = len(results)
+    return results_dict
+
+
+#   Full records grouped for json output, as returned by the search command
+def search_records(partial, search_type=None):
+    results = search_locally_with_partial(partial, exclude_ref_types=get_exclude_ref_types(search_type))
+    return results, prep_search_results(results)
+
+
+#   A page of display fields grouped for json output, as listed on the search page
+def search_display(partial, search_type=None):
+    return prep_display_results(search_page_with_partial(partial, exclude_ref_types=get_exclude_ref_types(search_type)))
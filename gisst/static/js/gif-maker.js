@@ -8,6 +8,7 @@ $(function(){
         var startMarker = $('#startMarkerButton');
         var endMarker = $('#endMarkerButton');
         var makeGIF = $('#makeGifButton');
+        var makeClip = $('#makeClipButton');
         var gifDeposit = $('#gifDeposit');
         var startTimeText = $('#startTime');
         var endTimeText = $('#endTime');
@@ -22,29 +23,60 @@ $(function(){
 
         makeGIF.click(function(e){
             e.preventDefault();
+            requestRender("/gif", "<p>Giffing...</p>", addGifToPage);
+        });
+
+        makeClip.click(function(e){
+            e.preventDefault();
+            requestRender("/clip", "<p>Clipping...</p>", addClipToPage);
+        });
+
+        function requestRender(url, message, addToPage){
             var start = parseInt(startTimeText.text());
             var end = parseInt(endTimeText.text());
             if(end - start > 0 && start < end){
                 $.ajax({
                     type: "POST",
-                    url: "/gif",
+                    url: url,
                     data: {
                         startTime: startTimeText.text(),
                         endTime: endTimeText.text(),
-                        source_hash: $('td:contains("replay_source_file_ref")').next().text(),
                         uuid: $('td').filter(function(index) { return $(this).text() === "uuid";}).next().text()
                     },
-                    success: addGifToPage
+                    success: function(job){ waitForRender(job, addToPage); }
                 });
-                gifDeposit.append("<p>Giffing...</p>");
+                gifDeposit.append(message);
             }
-        });
+        }
+
+        //  Renders run in the background, poll the job until it finishes unless the render was cached
+        function waitForRender(job, addToPage){
+            if(job['status'] === 'done'){
+                addToPage(job);
+                return;
+            }
+            $.getJSON(job['status_url'], function(status){
+                if(status['status'] === 'done'){
+                    addToPage(job);
+                } else if(status['status'] === 'failed'){
+                    gifDeposit.empty();
+                    gifDeposit.append("<p>Render failed: " + status['error'] + "</p>");
+                } else {
+                    setTimeout(function(){ waitForRender(job, addToPage); }, 1000);
+                }
+            });
+        }
 
         function addGifToPage(data){
             gifDeposit.empty();
             gifDeposit.append("<img src='"+data['gif_location']+"'/>");
         }
 
+        function addClipToPage(data){
+            gifDeposit.empty();
+            gifDeposit.append("<video controls src='"+data['clip_location']+"'></video>");
+        }
+
 
     });
 });
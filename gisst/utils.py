@@ -3,6 +3,7 @@ __author__ = 'erickaltman'
 from itertools import izip, tee
 from functools import wraps
 from collections import OrderedDict
+import threading
 import timeit
 
 # Pairwise non-overlap function from: http://stackoverflow.com/questions/5389507/iterating-over-every-two-elements-in-a-list
@@ -106,3 +107,59 @@ def clean_for_sqlite_query(text):
     puncs = (':', ',', '(', ')')
     funcs = [lambda t, x=x: t.replace(x, ' ') for x in puncs]
     return reduce(lambda y, z: z(y), funcs, text)
+
+
+# Bounded, thread safe least recently used cache with hit / miss counters
+class LRUCache(object):
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value    # re-insert as most recently used
+            self.hits += 1
+            return value
+
+    #   Changes on every invalidate or clear, see put
+    def version(self):
+        with self._lock:
+            return self._version
+
+    #   'version' is the cache version from before 'value' was read. If anything was invalidated
+    #   since, the value may predate that and isn't cached. Returns whether it was.
+    def put(self, key, value, version=None):
+        with self._lock:
+            if version is not None and version != self._version:
+                return False
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+            self._version += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._version += 1
+
+    def stats(self):
+        return {'size': len(self._items), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,154 @@
+__author__ = 'erickaltman'
+
+#   Single writer queue for SQLite. Under the threaded Flask server every request thread
+#   competes for the database write lock, so optionally all writes are handed to one thread
+#   with its own connection that drains the queue and commits several writes per transaction.
+
+import time
+import threading
+import Queue
+
+
+class WriteQueueError(Exception):
+    pass
+
+
+#   Minimal future, the standard library one is not available in Python 2
+class WriteFuture(object):
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise WriteQueueError('Timed out waiting for queued write.')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class WriteQueue(object):
+
+    #   'session_factory' creates the writer's dedicated session, 'execute' runs one
+    #   (session, query, parameters, many) write and returns its result
+    def __init__(self, session_factory, execute, max_batch=64, max_wait=0.01):
+        self.session_factory = session_factory
+        self.execute = execute
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = Queue.Queue()
+        self.commits = 0
+        self.writes = 0
+        self.failures = 0
+        #   Set if the writer thread died, later writes fail with it rather than wait forever
+        self.error = None
+        self._error_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name='gisst-db-writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, query, parameters=None, many=False):
+        future = WriteFuture()
+        #   executemany parameters may be a generator, which can't be replayed if the batch is retried
+        if many:
+            parameters = list(parameters)
+        with self._error_lock:
+            if self.error is not None:
+                future.set_exception(self.error)
+            else:
+                self.queue.put((query, parameters, many, future))
+        return future
+
+    def backlog(self):
+        return self.queue.qsize()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        return dict(backlog=self.backlog(), commits=self.commits, writes=self.writes, failures=self.failures,
+                    error=str(self.error) if self.error is not None else None)
+
+    def _next_batch(self, first):
+        batch = [first]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None)    # stop after this batch
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        batch = []
+        try:
+            session = self.session_factory()
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                batch = self._next_batch(item)
+                try:
+                    results = [self.execute(session, query, parameters, many) for query, parameters, many, _ in batch]
+                    session.commit()
+                except Exception:
+                    #   One bad write shouldn't fail the others, so replay the batch a write at a time
+                    session.rollback()
+                    for write in batch:
+                        self._run_alone(session, write)
+                else:
+                    for (_, _, _, future), result in zip(batch, results):
+                        future.set_result(result)
+                    self.commits += 1
+                self.writes += len(batch)
+            session.close()
+        #   Errors deriving from BaseException, like the other errors in gisst, end the thread
+        except BaseException as e:
+            self._stop_with_error(batch, e)
+
+    def _run_alone(self, session, write):
+        query, parameters, many, future = write
+        try:
+            result = self.execute(session, query, parameters, many)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            self.failures += 1
+            future.set_exception(e)
+        else:
+            self.commits += 1
+            future.set_result(result)
+
+    #   Fails the writes in hand and everything queued, and any submitted later
+    def _stop_with_error(self, batch, error):
+        with self._error_lock:
+            self.error = WriteQueueError('Database writer stopped: {}'.format(error))
+        for _, _, _, future in batch:
+            if not future.done():
+                future.set_exception(self.error)
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not None:
+                item[3].set_exception(self.error)
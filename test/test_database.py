@@ -1,8 +1,19 @@
 __author__ = 'erickaltman'
 
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
-from database import DatabaseManager, field_constraint, foreign_key
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker, scoped_session
+from database import DatabaseManager, field_constraint, foreign_key, set_sqlite_pragmas, SQLITE_PRAGMAS, Record
+from whoosh.index import create_in, open_dir
+from whoosh.query import Term
+from fts_index import FTSIndexManager, FTSWriteQueue, get_schema_version
+from whoosh.fields import Schema, ID
+from schema import generate_cite_ref, PERF_CITE_REF, PERF_SCHEMA_VERSION, GAME_CITE_REF, GAME_SCHEMA_VERSION
 
 
 class TestDatabaseMethods(unittest.TestCase):
@@ -55,3 +66,573 @@ class TestDatabaseMethods(unittest.TestCase):
     def tearDown(self):
         self.dbm.db.close()
         self.dbm.delete_db()
+
+
+class InMemoryDatabaseTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dbm = DatabaseManager
+        self.original_db = self.dbm.db
+        self.dbm.db = scoped_session(sessionmaker(bind=create_engine('sqlite://')))
+        for table in self.dbm.indexes:
+            self.assertTrue(self.dbm.create_table(table, self.dbm.fields[table]) is not None)
+        #   Updates to indexed tables write to the full text index, keep it out of the local data root
+        self.index_dir = tempfile.mkdtemp()
+        create_in(self.index_dir, schema=self.dbm.fts_schema)
+        self.original_fts_index = self.dbm.fts_index
+        self.dbm.fts_index = FTSIndexManager(self.index_dir, self.dbm.fts_schema)
+
+    def tearDown(self):
+        self.dbm.stop_fts_writer()
+        self.dbm.fts_index.close()
+        self.dbm.fts_index = self.original_fts_index
+        shutil.rmtree(self.index_dir)
+        self.dbm.db.remove()
+        self.dbm.db = self.original_db
+
+
+class TestDatabaseMigrations(InMemoryDatabaseTestCase):
+
+    def test_migrate_db(self):
+        self.assertEqual(self.dbm.get_db_version(), 0)
+        self.assertEqual(self.dbm.migrate_db(), self.dbm.migrations[-1][0])
+        self.assertEqual(self.dbm.get_db_version(), self.dbm.migrations[-1][0])
+        #   Running again is a no-op
+        self.assertEqual(self.dbm.migrate_db(), self.dbm.migrations[-1][0])
+
+    def test_uuid_lookup_uses_index(self):
+        self.dbm.migrate_db()
+        plan = self.dbm.run_query(r'explain query plan select * from {} where uuid=:uuid'.format(self.dbm.GAME_SAVE_TABLE),
+                                  {'uuid': 'abc'}, commit=False)
+        self.assertTrue(any('game_save_uuid_idx' in row[-1] for row in plan))
+
+
+class TestDatabasePagination(InMemoryDatabaseTestCase):
+
+    def setUp(self):
+        super(TestDatabasePagination, self).setUp()
+        for i in range(10):
+            self.dbm.add_to_save_state_table(game_uuid='game', description=u'state {}'.format(i))
+
+    def test_limit_and_start_index(self):
+        table = self.dbm.GAME_SAVE_TABLE
+        self.assertEqual(len(self.dbm.retrieve_all_from_table(table)), 10)
+        self.assertEqual(len(self.dbm.retrieve_attr_from_db('game_uuid', 'game', table, limit=1)), 1)
+        page = self.dbm.retrieve_attr_from_db('game_uuid', 'game', table, start_index=2, limit=5)
+        self.assertEqual([r[0] for r in page], [3, 4, 5])
+        self.assertEqual(self.dbm.retrieve_all_from_table(table, start_index=20), [])
+
+    def test_keyset_cursor(self):
+        table = self.dbm.GAME_SAVE_TABLE
+        page = self.dbm.retrieve_multiple_attr_from_db(['game_uuid'], ['game'], table, after_id=7)
+        self.assertEqual([r[0] for r in page], [8, 9, 10])
+        page = self.dbm.retrieve_all_from_table(table, limit=2, after_id=page[0][0])
+        self.assertEqual([r[0] for r in page], [9, 10])
+
+
+class TestPerformanceChain(InMemoryDatabaseTestCase):
+
+    def setUp(self):
+        super(TestPerformanceChain, self).setUp()
+        self.uuids = []
+        previous = None
+        for i in range(4):
+            perf = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION,
+                                     title=u'run {}'.format(i),
+                                     previous_performance_uuid=previous)
+            self.dbm.add_to_citation_table(perf)
+            previous = perf['uuid']
+            self.uuids.append(previous)
+
+    def test_retrieve_performance_chain(self):
+        chain = self.dbm.retrieve_performance_chain(self.uuids[-1])
+        self.assertEqual([p['uuid'] for p in chain], self.uuids)
+        chain = self.dbm.retrieve_performance_chain(self.uuids[-1], max_depth=1)
+        self.assertEqual([p['uuid'] for p in chain], self.uuids[-2:])
+        self.assertEqual(self.dbm.retrieve_performance_chain('not_a_uuid'), [])
+
+    def test_retrieve_performance_descendants(self):
+        descendants = self.dbm.retrieve_performance_descendants(self.uuids[0])
+        self.assertEqual([p['uuid'] for p in descendants], self.uuids[1:])
+        descendants = self.dbm.retrieve_performance_descendants(self.uuids[0], max_depth=2)
+        self.assertEqual([p['uuid'] for p in descendants], self.uuids[1:3])
+
+
+class TestStatePerformanceLinks(InMemoryDatabaseTestCase):
+
+    def test_retrieve_all_state_perf_links(self):
+        perf = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run')
+        self.dbm.add_to_citation_table(perf)
+        first = self.dbm.add_to_save_state_table(description=u'first')
+        second = self.dbm.add_to_save_state_table(description=u'second')
+        self.dbm.link_save_state_to_performance(first, perf['uuid'], 30, 'load')
+        self.dbm.link_save_state_to_performance(second, perf['uuid'], 10, 'save')
+
+        links = self.dbm.retrieve_all_state_perf_links(perf['uuid'])
+        self.assertEqual([l['time_index'] for l in links], [10, 30])
+        self.assertEqual([l['action'] for l in links], ['save', 'load'])
+        self.assertEqual([l['state_record']['uuid'] for l in links], [second, first])
+        self.assertEqual(links[0]['state_record']['description'], u'second')
+
+
+class TestTransactions(InMemoryDatabaseTestCase):
+
+    def test_transaction_commits_once(self):
+        commits = []
+        self.dbm.db.registry().commit = lambda: commits.append(True)
+        with self.dbm.transaction():
+            for i in range(5):
+                self.dbm.add_to_save_state_table(description=u'state {}'.format(i))
+            with self.dbm.transaction():
+                self.dbm.add_to_save_state_table(description=u'nested')
+        self.assertEqual(len(commits), 1)
+        self.assertFalse(self.dbm.in_transaction())
+
+    def test_transaction_rolls_back(self):
+        try:
+            with self.dbm.transaction():
+                self.dbm.add_to_save_state_table(uuid='rolled_back')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertFalse(self.dbm.is_attr_in_db('uuid', 'rolled_back', self.dbm.GAME_SAVE_TABLE))
+
+
+class TestBulkInsert(InMemoryDatabaseTestCase):
+
+    def test_bulk_insert_dicts_from_generator(self):
+        table = self.dbm.GAME_FILE_PATH_TABLE
+        rows = (dict(game_uuid='game', file_path=u'file_{}.txt'.format(i)) for i in range(100))
+        self.assertEqual(self.dbm.bulk_insert(table, rows), 100)
+        self.assertEqual(len(self.dbm.retrieve_file_path(game_uuid='game')), 100)
+
+    def test_bulk_insert_tuples(self):
+        table = self.dbm.SAVE_STATE_PERFORMANCE_LINK_TABLE
+        rows = [('perf', 'state_{}'.format(i), i, 'save') for i in range(3)]
+        self.assertEqual(self.dbm.bulk_insert(table, rows), 3)
+        self.assertEqual(self.dbm.bulk_insert(table, []), 0)
+        self.assertEqual(len(self.dbm.retrieve_attr_from_db('performance_uuid', 'perf', table)), 3)
+
+
+class TestSqlitePragmas(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///{}'.format(os.path.join(self.temp_dir, 'pragma.db')))
+        event.listen(self.engine, 'connect', set_sqlite_pragmas)
+
+    def test_pragmas_applied_on_connect(self):
+        connection = self.engine.connect()
+        self.assertEqual(connection.execute('pragma journal_mode').scalar(), 'wal')
+        self.assertEqual(connection.execute('pragma busy_timeout').scalar(), int(SQLITE_PRAGMAS['busy_timeout']))
+        self.assertEqual(connection.execute('pragma synchronous').scalar(), 1)     # NORMAL
+        connection.close()
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.temp_dir)
+
+
+class TestCitationContentHash(InMemoryDatabaseTestCase):
+
+    def test_duplicate_citation_rejected(self):
+        first = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run', performer=u'bob')
+        second = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run', performer=u'bob')
+        other = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run', performer=u'ted')
+        self.assertEqual(first.get_content_hash(), second.get_content_hash())
+        self.assertTrue(self.dbm.add_to_citation_table(first) is not False)
+        self.assertFalse(self.dbm.add_to_citation_table(second))
+        self.assertTrue(self.dbm.add_to_citation_table(other) is not False)
+
+    def test_concurrent_duplicate_rejected(self):
+        self.dbm.migrate_db()
+        first = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run', performer=u'bob')
+        second = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run', performer=u'bob')
+        self.assertTrue(self.dbm.add_to_citation_table(first, fts=True) is not False)
+        check_for_duplicate_citation = self.dbm.__dict__['check_for_duplicate_citation']
+        #   As if the identical insert landed between the duplicate check and this insert
+        self.dbm.check_for_duplicate_citation = staticmethod(lambda cite_ref, table: False)
+        try:
+            self.assertFalse(self.dbm.add_to_citation_table(second, fts=True))
+        finally:
+            self.dbm.check_for_duplicate_citation = check_for_duplicate_citation
+        self.assertEqual(self.dbm.get_duplicate_citation_uuid(second), first['uuid'])
+        self.assertTrue(self.dbm.flush_fts(timeout=10))
+        self.assertEqual([r['uuid'] for r in self.dbm.retrieve_from_fts(u'run')], [first['uuid']])
+        #   The session is usable afterwards
+        other = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run', performer=u'ted')
+        self.assertTrue(self.dbm.add_to_citation_table(other) is not False)
+
+    def test_update_rehashes_citation(self):
+        self.dbm.migrate_db()
+        table = self.dbm.PERFORMANCE_CITATION_TABLE
+        cite = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run', performer=u'bob')
+        self.dbm.add_to_citation_table(cite)
+        self.dbm.update_table(table, ['performer'], [u'ted'], ['uuid'], [cite['uuid']])
+
+        old_content = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run', performer=u'bob')
+        new_content = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run', performer=u'ted')
+        self.assertTrue(self.dbm.add_to_citation_table(old_content) is not False)
+        self.assertFalse(self.dbm.add_to_citation_table(new_content))
+        #   Updating into a copy of another row leaves a null hash rather than breaking the unique index
+        self.dbm.update_table(table, ['performer'], [u'ted'], ['uuid'], [old_content['uuid']])
+        hashes = [row[0] for row in self.dbm.run_query(r'select content_hash from {} order by id'.format(table))]
+        self.assertEqual(hashes, [new_content.get_content_hash(), None])
+
+    def test_migration_backfills_hashes(self):
+        table = self.dbm.PERFORMANCE_CITATION_TABLE
+        self.dbm.run_query(r'drop table {}'.format(table))
+        self.dbm.create_table(table, [f for f in self.dbm.fields[table] if f[0] != 'content_hash'])
+        cite = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run')
+        headers = [h for h in self.dbm.headers[table] if h != 'content_hash']
+        for _ in range(2):
+            values = [None] + list(cite.get_element_values()) + [None, cite.to_json_string()]
+            self.dbm.insert_into_table(table, headers, values)
+
+        self.dbm.migrate_db()
+        hashes = [row[0] for row in self.dbm.run_query(r'select content_hash from {} order by id'.format(table))]
+        self.assertEqual(hashes, [cite.get_content_hash(), None])
+        self.assertTrue(self.dbm.check_for_duplicate_citation(cite, table))
+
+
+class TestColumnProjection(InMemoryDatabaseTestCase):
+
+    def test_projected_retrieval(self):
+        table = self.dbm.PERFORMANCE_CITATION_TABLE
+        columns = self.dbm.list_columns[table]
+        perf = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run', game_uuid='game',
+                                 input_events=u'x' * 1000, notes=u'n', additional_info=u'a')
+        self.dbm.add_to_citation_table(perf)
+        self.assertFalse('input_events' in columns)
+
+        rows = self.dbm.retrieve_attr_from_db('uuid', perf['uuid'], table, columns=('uuid', 'title'))
+        self.assertEqual(rows, [(perf['uuid'], u'run')])
+
+        derived = self.dbm.retrieve_derived_performances('game', columns=columns)
+        self.assertEqual(derived[0]['uuid'], perf['uuid'])
+        self.assertEqual(derived[0]['title'], u'run')
+        self.assertEqual(derived[0]['input_events'], None)
+        #   Fields the player's info table edits are kept
+        self.assertEqual((derived[0]['notes'], derived[0]['additional_info']), (u'n', u'a'))
+        chain = self.dbm.retrieve_performance_chain(perf['uuid'], columns=columns)
+        self.assertEqual(chain[0]['uuid'], perf['uuid'])
+
+    def test_projected_save_state(self):
+        state_uuid = self.dbm.add_to_save_state_table(game_uuid='game', description=u'state')
+        state = self.dbm.retrieve_save_state(columns=('uuid', 'game_uuid'), uuid=state_uuid)[0]
+        self.assertEqual(state.items(), [('uuid', state_uuid), ('game_uuid', 'game')])
+
+    def test_save_state_record(self):
+        state_uuid = self.dbm.add_to_save_state_table(game_uuid='game', description=u'state')
+        state = self.dbm.retrieve_save_state(uuid=state_uuid)[0]
+        self.assertTrue(isinstance(state, Record))
+        self.assertFalse(hasattr(state, '__dict__'))
+        self.assertEqual(state['description'], u'state')
+        self.assertEqual(state.keys(), self.dbm.headers[self.dbm.GAME_SAVE_TABLE])
+        state['description'] = u'changed'
+        self.assertEqual(state._asdict()['description'], u'changed')
+        self.assertRaises(KeyError, state.__setitem__, 'not_a_field', 1)
+        self.assertTrue(type(state) is type(self.dbm.retrieve_save_state(uuid=state_uuid)[0]))
+
+
+class TestCiteCache(InMemoryDatabaseTestCase):
+
+    def setUp(self):
+        super(TestCiteCache, self).setUp()
+        self.dbm.cite_cache.clear()
+        self.perf = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run', game_uuid='game')
+        self.dbm.add_to_citation_table(self.perf)
+
+    def test_cache_hit_returns_copy(self):
+        hits = self.dbm.cite_cache.hits
+        first = self.dbm.retrieve_perf_ref(self.perf['uuid'])
+        first['title'] = u'changed'
+        second = self.dbm.retrieve_perf_ref(self.perf['uuid'])
+        self.assertEqual(second['title'], u'run')
+        self.assertEqual(self.dbm.cite_cache.hits, hits + 1)
+        self.assertEqual(self.dbm.retrieve_game_ref(self.perf['uuid']), None)
+
+    def test_update_and_delete_invalidate(self):
+        table = self.dbm.PERFORMANCE_CITATION_TABLE
+        self.dbm.retrieve_perf_ref(self.perf['uuid'])
+        self.dbm.update_table(table, ['title'], [u'new title'], ['uuid'], [self.perf['uuid']])
+        self.assertEqual(self.dbm.retrieve_perf_ref(self.perf['uuid'])['title'], u'new title')
+        self.dbm.delete_from_table(table, ['game_uuid'], ['game'])
+        self.assertEqual(self.dbm.retrieve_perf_ref(self.perf['uuid']), None)
+
+    def test_update_during_read_not_cached_stale(self):
+        table = self.dbm.PERFORMANCE_CITATION_TABLE
+        retrieve_attr_from_db = self.dbm.__dict__['retrieve_attr_from_db']
+        read_row = retrieve_attr_from_db.__get__(None, self.dbm)
+
+        #   The row is read, then updated by another request before it's cached
+        def read_then_update(*args, **kwargs):
+            rows = read_row(*args, **kwargs)
+            self.dbm.update_table(table, ['title'], [u'new title'], ['uuid'], [self.perf['uuid']])
+            return rows
+
+        self.dbm.retrieve_attr_from_db = staticmethod(read_then_update)
+        try:
+            self.assertEqual(self.dbm.retrieve_perf_ref(self.perf['uuid'])['title'], u'run')
+        finally:
+            self.dbm.retrieve_attr_from_db = retrieve_attr_from_db
+        self.assertEqual(self.dbm.retrieve_perf_ref(self.perf['uuid'])['title'], u'new title')
+
+    def tearDown(self):
+        self.dbm.cite_cache.clear()
+        super(TestCiteCache, self).tearDown()
+
+
+class TestFTSIndexManager(InMemoryDatabaseTestCase):
+
+    def test_searcher_reuse(self):
+        fts_index = self.dbm.fts_index
+        self.dbm.add_to_fts(u'zelda link', title=u'Zelda', id=u'1', tags=u'game')
+        self.dbm.flush_fts()
+        self.assertEqual(self.dbm.retrieve_from_fts(u'zelda'), [{'uuid': u'1', 'tags': u'game'}])
+        with fts_index.searcher() as first:
+            pass
+        self.assertEqual(self.dbm.retrieve_from_fts(u'link'), [{'uuid': u'1', 'tags': u'game'}])
+        with fts_index.searcher() as second:
+            self.assertTrue(first is second)
+        self.assertTrue(fts_index.get_parser('content') is fts_index.get_parser('content'))
+        self.assertEqual(fts_index.refreshes, 0)
+
+        #   A new generation is picked up on the next search
+        self.dbm.add_to_fts(u'zelda adventure', title=u'Zelda II', id=u'2', tags=u'game')
+        self.dbm.flush_fts()
+        self.assertEqual(sorted(r['uuid'] for r in self.dbm.retrieve_from_fts(u'zelda')), [u'1', u'2'])
+        self.assertEqual(fts_index.refreshes, 1)
+
+    def test_concurrent_searchers(self):
+        fts_index = self.dbm.fts_index
+        self.dbm.add_to_fts(u'zelda link', title=u'Zelda', id=u'1', tags=u'game')
+        self.dbm.flush_fts()
+        searching, done = threading.Event(), threading.Event()
+        searchers = []
+
+        def search_in_thread():
+            with fts_index.searcher() as searcher:
+                searchers.append(searcher)
+                searching.set()
+                done.wait(5)
+
+        thread = threading.Thread(target=search_in_thread)
+        thread.start()
+        self.assertTrue(searching.wait(5))
+        #   A search on this thread doesn't wait for the other thread's search to finish
+        self.assertEqual(self.dbm.retrieve_from_fts(u'zelda'), [{'uuid': u'1', 'tags': u'game'}])
+        with fts_index.searcher() as searcher:
+            self.assertFalse(searcher is searchers[0])
+        done.set()
+        thread.join()
+
+    def test_searchers_shared_between_threads(self):
+        fts_index = self.dbm.fts_index
+        self.dbm.add_to_fts(u'zelda link', title=u'Zelda', id=u'1', tags=u'game')
+        self.dbm.flush_fts()
+        results = []
+
+        #   Like the threaded server, each search runs on a new thread
+        def search_in_thread():
+            results.append(self.dbm.retrieve_from_fts(u'zelda'))
+
+        for i in range(5):
+            thread = threading.Thread(target=search_in_thread)
+            thread.start()
+            thread.join()
+        self.assertEqual(results, [[{'uuid': u'1', 'tags': u'game'}]] * 5)
+        self.assertEqual((fts_index.opens, fts_index.refreshes), (1, 0))
+
+        #   A borrowed searcher is closed when it's returned after close()
+        with fts_index.searcher() as searcher:
+            fts_index.close()
+        self.assertTrue(searcher.is_closed)
+        self.assertEqual(self.dbm.retrieve_from_fts(u'link'), [{'uuid': u'1', 'tags': u'game'}])
+        self.assertEqual(fts_index.opens, 2)
+
+
+class TestFTSWriteQueue(InMemoryDatabaseTestCase):
+
+    def test_batched_commits(self):
+        for i in range(20):
+            self.dbm.add_to_fts(u'game {}'.format(i), title=u'game', id=unicode(i), tags=u'game')
+        self.dbm.delete_from_fts(u'0')
+        self.assertTrue(self.dbm.flush_fts(timeout=10))
+        writer = self.dbm.fts_writer
+        self.assertEqual(writer.backlog(), 0)
+        self.assertEqual(writer.documents, 21)
+        self.assertTrue(writer.commits < 21)
+        self.assertEqual(len(self.dbm.retrieve_from_fts(u'game', limit=50)), 19)
+
+    def test_update_reindexes(self):
+        perf = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'first run', game_uuid='game')
+        self.dbm.add_to_citation_table(perf, fts=True)
+        state_uuid = self.dbm.add_to_save_state_table(fts=True, game_uuid='game', description=u'castle')
+        self.dbm.flush_fts()
+        #   A long batch window keeps the updates queued while the same citation is updated again
+        self.dbm.stop_fts_writer()
+        self.dbm.fts_writer = writer = FTSWriteQueue(self.dbm.fts_index, max_wait=5)
+        for title in (u'second run', u'speed run'):
+            self.dbm.update_table(self.dbm.PERFORMANCE_CITATION_TABLE, ['title'], [title], ['uuid'], [perf['uuid']])
+        self.dbm.update_table(self.dbm.GAME_SAVE_TABLE, ['description'], [u'dungeon'], ['uuid'], [state_uuid])
+        self.assertEqual(writer.coalesced, 1)
+        self.dbm.flush_fts()
+        self.assertEqual(writer.documents, 2)
+        self.assertEqual(self.dbm.retrieve_from_fts(u'speed'), [{'uuid': perf['uuid'], 'tags': PERF_CITE_REF}])
+        self.assertEqual(self.dbm.retrieve_from_fts(u'second'), [])
+        self.assertEqual([r['uuid'] for r in self.dbm.retrieve_from_fts(u'dungeon')], [state_uuid])
+        self.assertEqual(self.dbm.retrieve_from_fts(u'castle'), [])
+
+    def test_locked_index_retried(self):
+        self.dbm.fts_writer = writer = FTSWriteQueue(self.dbm.fts_index, max_wait=0, lock_timeout=0.05,
+                                                     lock_retries=3, retry_delay=0.1)
+        lock_holder = self.dbm.fts_index.writer(blocking=True)
+        release = threading.Timer(0.2, lock_holder.cancel)
+        release.start()
+        self.dbm.add_to_fts(u'zelda', id=u'1', tags=u'game')
+        self.assertTrue(self.dbm.flush_fts(timeout=10))
+        self.assertEqual([r['uuid'] for r in self.dbm.retrieve_from_fts(u'zelda')], [u'1'])
+
+        #   A batch that can't get the lock at all is reported by the next flush only
+        writer.lock_retries = 0
+        lock_holder = self.dbm.fts_index.writer(blocking=True)
+        self.dbm.add_to_fts(u'metroid', id=u'2', tags=u'game')
+        self.assertFalse(self.dbm.flush_fts(timeout=10))
+        self.assertEqual(writer.failures, 1)
+        lock_holder.cancel()
+        self.assertTrue(self.dbm.flush_fts(timeout=10))
+
+    def test_bad_document_skipped(self):
+        self.dbm.add_to_fts(u'zelda', id=u'1', tags=u'game')
+        self.dbm.get_fts_writer().add_document(content=u'metroid', id=u'2', not_a_field=u'x')
+        self.dbm.add_to_fts(u'zelda adventure', id=u'3', tags=u'game')
+        self.assertFalse(self.dbm.flush_fts(timeout=10))
+        self.assertEqual(sorted(r['uuid'] for r in self.dbm.retrieve_from_fts(u'zelda')), [u'1', u'3'])
+        self.assertEqual(self.dbm.fts_writer.stats()['skipped'], 1)
+        self.assertTrue(self.dbm.stop_fts_writer())
+
+
+class TestRebuildFTS(InMemoryDatabaseTestCase):
+
+    def test_rebuild_swaps_in_new_index(self):
+        self.dbm.create_table(self.dbm.EXTRACTED_TABLE, self.dbm.fields[self.dbm.EXTRACTED_TABLE])
+        perf = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'speed run', game_uuid='game')
+        self.dbm.add_to_citation_table(perf)
+        state_uuid = self.dbm.add_to_save_state_table(game_uuid='game', description=u'castle')
+        self.dbm.add_to_extracted_table({'title': u'extracted page', 'source_file_hash': 'abc'})
+        self.dbm.add_to_fts(u'stale document', id=u'stale')
+        self.dbm.flush_fts()
+        old_searcher = open_dir(self.index_dir).searcher()
+
+        self.assertEqual(self.dbm.rebuild_fts(procs=2, page_size=1), 3)
+        self.assertFalse(os.path.exists(self.index_dir + '_rebuild'))
+        #   A searcher opened before the swap still reads the old generation
+        self.assertEqual(old_searcher.doc_count(), 1)
+        self.assertEqual([hit['id'] for hit in old_searcher.search(Term('content', u'stale'))], [u'stale'])
+        old_searcher.close()
+        self.assertEqual(self.dbm.retrieve_from_fts(u'stale'), [])
+        self.assertEqual(self.dbm.retrieve_from_fts(u'speed'), [{'uuid': perf['uuid'], 'tags': PERF_CITE_REF}])
+        self.assertEqual([r['uuid'] for r in self.dbm.retrieve_from_fts(u'castle')], [state_uuid])
+        with self.dbm.fts_index.searcher() as searcher:
+            self.assertEqual(searcher.doc_count(), 3)
+
+    def test_write_during_rebuild_survives_swap(self):
+        #   The rebuild below outlasts this writer's lock timeout and retries
+        self.dbm.fts_writer = writer = FTSWriteQueue(self.dbm.fts_index, max_wait=0, lock_timeout=0.05,
+                                                     lock_retries=1, retry_delay=0.05)
+        self.dbm.add_to_fts(u'before rebuild', id=u'before')
+        self.dbm.flush_fts()
+        iter_fts_documents = self.dbm.__dict__['iter_fts_documents']
+
+        #   A document written while the table scan runs, after the scan passed it
+        def scan(page_size):
+            yield dict(id=u'before', content=u'before rebuild')
+            self.dbm.add_to_fts(u'during rebuild', id=u'during')
+            #   The write waits on the rebuild's lock rather than landing in the old index
+            self.assertFalse(self.dbm.flush_fts(timeout=1))
+            yield dict(id=u'during', content=u'during rebuild')
+
+        self.dbm.iter_fts_documents = staticmethod(scan)
+        try:
+            self.assertEqual(self.dbm.rebuild_fts(procs=1), 2)
+        finally:
+            self.dbm.iter_fts_documents = iter_fts_documents
+        self.assertTrue(self.dbm.flush_fts(timeout=10))
+        self.assertEqual(writer.failures, 0)
+        with self.dbm.fts_index.searcher() as searcher:
+            self.assertEqual(sorted(hit['id'] for hit in searcher.search(Term('content', u'rebuild'))),
+                             [u'before', u'during'])
+
+
+class TestBatchedRetrieval(InMemoryDatabaseTestCase):
+
+    def test_retrieve_cite_refs(self):
+        perfs = [generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run {}'.format(i), game_uuid='game')
+                 for i in range(5)]
+        for perf in perfs:
+            self.dbm.add_to_citation_table(perf)
+        uuids = [perfs[3]['uuid'], 'missing', perfs[0]['uuid'], perfs[4]['uuid']]
+        self.assertEqual(len(self.dbm.retrieve_rows_by_uuid(self.dbm.PERFORMANCE_CITATION_TABLE, uuids, chunk_size=2)), 3)
+        self.assertEqual([p['title'] for p in self.dbm.retrieve_cite_refs(PERF_CITE_REF, uuids)],
+                         [u'run 3', u'run 0', u'run 4'])
+        state_uuid = self.dbm.add_to_save_state_table(game_uuid='game', description=u'castle')
+        self.assertEqual([s['description'] for s in self.dbm.retrieve_save_states(['missing', state_uuid])], [u'castle'])
+
+    def test_stored_display_fields(self):
+        perf = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'speed run', game_uuid='game',
+                                 performer=u'someone')
+        self.dbm.add_to_citation_table(perf, fts=True)
+        self.dbm.flush_fts()
+        hit = self.dbm.retrieve_from_fts(u'speed', stored_fields=True)[0]
+        self.assertEqual(hit['uuid'], perf['uuid'])
+        self.assertEqual(hit['title'], u'speed run')
+        self.assertEqual(hit['performer'], u'someone')
+        self.assertEqual(hit['game_uuid'], 'game')
+        self.assertFalse('content' in hit)
+
+
+class TestStructuredFTSSchema(InMemoryDatabaseTestCase):
+
+    def test_field_queries(self):
+        game = generate_cite_ref(GAME_CITE_REF, GAME_SCHEMA_VERSION, title=u'Zelda', platform=u'NES',
+                                 developer=u'Nintendo', copyright_year=u'1986', notes=u'classic')
+        other = generate_cite_ref(GAME_CITE_REF, GAME_SCHEMA_VERSION, title=u'Metroid', platform=u'NES',
+                                  notes=u'zelda like', copyright_year=u'Aug 1986')
+        for cite in (game, other):
+            self.dbm.add_to_citation_table(cite, fts=True)
+        self.dbm.flush_fts()
+
+        fields = self.dbm.get_cite_fts_fields(game)
+        self.assertEqual(fields['content'], u'classic')
+        self.assertEqual(fields['year'], 1986)
+        #   Title matches rank above matches in other text
+        self.assertEqual([r['uuid'] for r in self.dbm.retrieve_from_fts(u'zelda')], [game['uuid'], other['uuid']])
+        self.assertEqual(len(self.dbm.retrieve_from_fts(u'platform:NES year:1986')), 2)
+        self.assertEqual([r['uuid'] for r in self.dbm.retrieve_from_fts(u'developer:nintendo')], [game['uuid']])
+
+    def test_schema_version(self):
+        self.assertEqual(get_schema_version(self.dbm.fts_index.get_index().schema), self.dbm.FTS_SCHEMA_VERSION)
+        self.assertEqual(get_schema_version(Schema(id=ID)), 1)
+
+    def test_search_page(self):
+        for i in range(25):
+            cite = generate_cite_ref(GAME_CITE_REF, GAME_SCHEMA_VERSION, title=u'Quest {}'.format(i),
+                                     platform=u'Game Boy' if i % 5 else None,
+                                     copyright_year=u'1990' if i < 12 else None)
+            self.dbm.add_to_citation_table(cite, fts=True)
+        perf = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'Quest run')
+        self.dbm.add_to_citation_table(perf, fts=True)
+        self.dbm.flush_fts()
+
+        self.assertEqual(len(self.dbm.retrieve_from_fts(u'quest')), 26)
+        page = self.dbm.search_fts_page(u'quest', page=2, page_length=10, stored_fields=True)
+        self.assertEqual((page['total'], page['page'], page['page_count']), (26, 2, 3))
+        self.assertEqual(len(page['hits']), 10)
+        self.assertTrue(all('title' in hit for hit in page['hits']))
+        self.assertEqual(page['facets']['tags'], {GAME_CITE_REF: 25, PERF_CITE_REF: 1})
+        self.assertEqual(page['facets']['platform'], {u'Game Boy': 20})
+        self.assertEqual(page['facets']['year'], {1990: 12})
+        for pagenum in (0, -1):
+            page = self.dbm.search_fts_page(u'quest', page=pagenum, page_length=10)
+            self.assertEqual((page['page'], len(page['hits'])), (1, 10))
@@ -0,0 +1,66 @@
+__author__ = 'erickaltman'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from derivative_cache import DerivativeCache
+from render import render_gif, get_gif_params, RenderError
+
+
+class TestDerivativeCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = DerivativeCache(self.cache_dir, max_size=10)
+        self.perf = dict(uuid=u'perf', replay_source_file_ref=u'abc', replay_source_file_name=u'run.mp4')
+
+    def write(self, data):
+        def render(path):
+            with open(path, 'wb') as f:
+                f.write(data)
+        return render
+
+    def test_get_or_render(self):
+        params = get_gif_params(self.perf, 0, 5)
+        self.assertEqual(self.cache.get(params), None)
+        file_ref = self.cache.get_or_render(params, self.write('gif'))
+        self.assertTrue(file_ref.endswith('.gif'))
+        #   Cached renders are not repeated
+        self.assertEqual(self.cache.get_or_render(params, self.write('other')), file_ref)
+        with open(self.cache.get_path(file_ref)) as f:
+            self.assertEqual(f.read(), 'gif')
+        self.assertNotEqual(self.cache.get_file_ref(get_gif_params(self.perf, 0, 5, fps=15)), file_ref)
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries'], stats['size']), (1, 2, 1, 3))
+
+    def test_least_recently_used_evicted(self):
+        first, second, third = [get_gif_params(self.perf, i, i + 1) for i in range(3)]
+        self.cache.get_or_render(first, self.write('1234'))
+        self.cache.get_or_render(second, self.write('1234'))
+        self.cache.get(first)
+        self.cache.get_or_render(third, self.write('1234'))
+        self.assertEqual(self.cache.get(second), None)
+        self.assertTrue(self.cache.get(first) and self.cache.get(third))
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+        #   Files on disk are picked up again by a new cache
+        self.assertEqual(DerivativeCache(self.cache_dir).stats()['entries'], 2)
+
+    def test_failed_render(self):
+        params = get_gif_params(self.perf, 0, 5)
+
+        def fail(path):
+            self.write('partial')(path)
+            raise RenderError('ffmpeg failed')
+        self.assertRaises(RenderError, self.cache.get_or_render, params, fail)
+        self.assertEqual(self.cache.get(params), None)
+        self.assertEqual(os.listdir(os.path.dirname(self.cache.get_path(self.cache.get_file_ref(params)))), [])
+
+    def test_render_gif_uses_cache(self):
+        file_ref = self.cache.get_or_render(get_gif_params(self.perf, 0, 5), self.write('gif'))
+        self.assertEqual(render_gif(self.perf, 0, 5, cache=self.cache), file_ref)
+        self.assertRaises(RenderError, render_gif, self.perf, 5, 0, cache=self.cache)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
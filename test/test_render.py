@@ -0,0 +1,99 @@
+__author__ = 'erickaltman'
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+import render
+from derivative_cache import DerivativeCache
+from render import render_gif, render_clip, render_batch, group_ranges, get_batch_gif_filter, RenderError
+
+#   Stands in for ffmpeg, records its arguments in each output file (the last argument and any
+#   file following a -map)
+FAKE_FFMPEG = '''#!{}
+import sys, json
+args = sys.argv[1:]
+for path in set([args[-1]] + [args[i + 2] for i, a in enumerate(args) if a == '-map']):
+    with open(path, 'w') as f:
+        json.dump(args, f)
+'''
+
+
+class TestRender(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        #   Room for the recorded arguments
+        self.cache = DerivativeCache(self.cache_dir, max_size=1024 ** 2)
+        self.perf = dict(uuid=u'perf', replay_source_file_ref=u'abc', replay_source_file_name=u'run.mp4')
+        ffmpeg_path = os.path.join(self.cache_dir, 'ffmpeg')
+        with open(ffmpeg_path, 'w') as f:
+            f.write(FAKE_FFMPEG.format(sys.executable))
+        os.chmod(ffmpeg_path, 0755)
+        self.original_ffmpeg_path = render.FFMPEG_PATH
+        render.FFMPEG_PATH = ffmpeg_path
+
+    def read_args(self, file_ref):
+        with open(self.cache.get_path(file_ref)) as f:
+            return json.load(f)
+
+    def test_gif_single_pass(self):
+        args = self.read_args(render_gif(self.perf, 30, 35, cache=self.cache))
+        #   Input seeking, and the palette made and applied in one graph
+        self.assertLess(args.index('-ss'), args.index('-i'))
+        self.assertIn('palettegen', args[args.index('-filter_complex') + 1])
+        self.assertIn('paletteuse', args[args.index('-filter_complex') + 1])
+        self.assertEqual(len([a for a in args if a == '-i']), 1)
+
+    def test_clip_stream_copy(self):
+        file_ref = render_clip(self.perf, 30, 35, cache=self.cache)
+        self.assertTrue(file_ref.endswith('.mp4'))
+        args = self.read_args(file_ref)
+        self.assertEqual(args[args.index('-c') + 1], 'copy')
+        self.assertEqual(args[args.index('-t') + 1], '5')
+        self.assertLess(args.index('-ss'), args.index('-i'))
+
+    def test_batch_render(self):
+        cached = render_gif(self.perf, 100, 110, cache=self.cache)
+        results = render_batch(self.perf, [(200, 205), (100, 110), (0, 5), (10, 12), (200, 205)], cache=self.cache)
+        self.assertEqual([(r['start'], r['end']) for r in results], [(200, 205), (100, 110), (0, 5), (10, 12), (200, 205)])
+        self.assertEqual(results[1]['file_ref'], cached)
+        #   Nearby ranges share a decoding pass with an output per range
+        args = self.read_args(results[2]['file_ref'])
+        self.assertEqual(args, self.read_args(results[3]['file_ref']))
+        self.assertEqual(args[args.index('-t') + 1], '12')
+        self.assertEqual(len([a for a in args if a == '-map']), 2)
+        self.assertIn('trim=start=10:end=12', args[args.index('-filter_complex') + 1])
+        self.assertNotEqual(self.read_args(results[0]['file_ref']), args)
+        self.assertTrue(all(r['error'] is None for r in results))
+
+    def test_batch_clips(self):
+        results = render_batch(self.perf, [(0, 5), (10, 12)], format='mp4', cache=self.cache, procs=2)
+        self.assertTrue(all(r['file_ref'].endswith('.mp4') for r in results))
+        args = self.read_args(results[1]['file_ref'])
+        self.assertEqual(args[args.index('-ss') + 1], '10')
+        self.assertRaises(RenderError, render_batch, self.perf, [(0, 5)], format='avi', cache=self.cache)
+
+    def test_render_checks(self):
+        self.assertRaises(RenderError, render_gif, self.perf, -5, 5, cache=self.cache)
+        self.assertRaises(RenderError, render_clip, self.perf, 10, 10, cache=self.cache)
+        no_video = dict(self.perf, replay_source_file_ref=None)
+        self.assertRaises(RenderError, render_batch, no_video, [(0, 5)], cache=self.cache)
+
+    def test_group_ranges(self):
+        groups = group_ranges([(100, 110), (0, 5), (10, 12), (200, 205)], max_gap=30)
+        self.assertEqual([g['ranges'] for g in groups], [[(0, 5), (10, 12)], [(100, 110)], [(200, 205)]])
+        self.assertEqual((groups[0]['start'], groups[0]['end']), (0, 12))
+
+    def test_batch_gif_filter(self):
+        graph = get_batch_gif_filter([(10, 15), (20, 22)], 10, fps=5, width=100)
+        self.assertTrue(graph.startswith('[0:v]fps=5,scale=100:-1:flags=lanczos,split=2[s0][s1];'))
+        self.assertIn('[s1]trim=start=10:end=12,', graph)
+        self.assertTrue(graph.endswith('[y1][p1]paletteuse[o1]'))
+
+    def tearDown(self):
+        render.FFMPEG_PATH = self.original_ffmpeg_path
+        shutil.rmtree(self.cache_dir)
@@ -0,0 +1,52 @@
+__author__ = 'erickaltman'
+
+import threading
+import unittest
+
+from render_queue import RenderJobQueue, JOB_QUEUED, JOB_DONE, JOB_FAILED
+from render import RenderError
+
+
+class TestRenderJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.jobs = RenderJobQueue(workers=1, max_finished=2)
+        self.release = threading.Event()
+
+    def render(self, value):
+        self.release.wait(5)
+        return value * 2
+
+    def fail(self):
+        raise RenderError('no video')
+
+    def test_identical_jobs_collapse(self):
+        job = self.jobs.submit(('perf', 0, 5), self.render, 2)
+        self.assertTrue(self.jobs.submit(('perf', 0, 5), self.render, 2) is job)
+        other = self.jobs.submit(('perf', 5, 10), self.render, 3)
+        self.assertEqual(other.status, JOB_QUEUED)
+        self.release.set()
+        self.assertTrue(other.wait(5))
+        self.assertEqual((job.status, job.result, other.result), (JOB_DONE, 4, 6))
+        self.assertEqual(self.jobs.get(job.id).to_json_dict()['status'], JOB_DONE)
+        #   A finished job no longer collapses new submissions
+        self.assertFalse(self.jobs.submit(('perf', 0, 5), self.render, 2) is job)
+        stats = self.jobs.stats()
+        self.assertEqual((stats['submitted'], stats['collapsed']), (3, 1))
+
+    def test_failed_job(self):
+        job = self.jobs.submit('bad', self.fail)
+        self.assertTrue(job.wait(5))
+        self.assertEqual((job.status, job.error), (JOB_FAILED, 'no video'))
+        self.assertEqual(self.jobs.stats()['failures'], 1)
+
+    def test_finished_jobs_pruned(self):
+        self.release.set()
+        jobs = [self.jobs.submit(i, self.render, i) for i in range(4)]
+        jobs[-1].wait(5)
+        self.assertEqual(self.jobs.get(jobs[0].id), None)
+        self.assertTrue(self.jobs.get(jobs[-1].id) is jobs[-1])
+
+    def tearDown(self):
+        self.release.set()
+        self.jobs.stop()
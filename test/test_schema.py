@@ -0,0 +1,53 @@
+__author__ = 'erickaltman'
+
+import json
+import datetime
+import unittest
+
+from schema import (
+    generate_cite_ref,
+    to_json,
+    CiteRef,
+    SchemaError,
+    GAME_CITE_REF,
+    PERF_CITE_REF,
+    GAME_SCHEMA_VERSION,
+    PERF_SCHEMA_VERSION,
+    PERFORMANCE_SCHEMA
+)
+
+
+class TestCiteRef(unittest.TestCase):
+
+    def test_compiled_class(self):
+        perf = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run', not_an_element=1)
+        other = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'other')
+        self.assertTrue(isinstance(perf, CiteRef))
+        self.assertTrue(type(perf) is type(other))
+        self.assertFalse(hasattr(perf, '__dict__'))
+        self.assertEqual(perf.ref_type, PERF_CITE_REF)
+        self.assertEqual(perf.get_element_names(), tuple([e for e, _ in PERFORMANCE_SCHEMA['version'][PERF_SCHEMA_VERSION]['elements']]))
+        self.assertEqual(perf.get_required_elements(), ('title', 'uuid', 'schema_version'))
+        self.assertEqual(perf['schema_version'], '0.1.0')
+        self.assertTrue(perf['uuid'])
+        self.assertFalse('not_an_element' in perf)
+        self.assertRaises(SchemaError, generate_cite_ref, GAME_CITE_REF, u'9.9.9')
+
+    def test_elements(self):
+        game = generate_cite_ref(GAME_CITE_REF, GAME_SCHEMA_VERSION, title=u'Zelda')
+        game['platform'] = u'NES'
+        self.assertEqual(game.elements.items()[:3], [('title', u'Zelda'), ('uuid', game['uuid']), ('platform', u'NES')])
+        game.elements = {'developer': u'Nintendo', 'not_an_element': 1}
+        self.assertEqual(game['developer'], u'Nintendo')
+        self.assertRaises(KeyError, game.__setitem__, 'not_an_element', 1)
+
+        game_copy = game.copy()
+        game_copy['title'] = u'Zelda II'
+        self.assertEqual(game['title'], u'Zelda')
+
+    def test_to_json(self):
+        start = datetime.datetime(2017, 1, 2, 3, 4, 5)
+        perf = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'run', start_datetime=start)
+        self.assertEqual(json.loads(perf.to_json_string())['start_datetime'], start.isoformat())
+        game = generate_cite_ref(GAME_CITE_REF, GAME_SCHEMA_VERSION, title=u'Zelda')
+        self.assertEqual([c['title'] for c in json.loads(to_json([perf, game]))], [u'run', u'Zelda'])
@@ -0,0 +1,39 @@
+__author__ = 'erickaltman'
+
+from test_database import InMemoryDatabaseTestCase
+from search_service import search_records, search_display, get_exclude_ref_types
+from schema import generate_cite_ref, GAME_CITE_REF, PERF_CITE_REF, STATE_CITE_REF, GAME_SCHEMA_VERSION, PERF_SCHEMA_VERSION
+
+
+class TestSearchService(InMemoryDatabaseTestCase):
+
+    def setUp(self):
+        super(TestSearchService, self).setUp()
+        self.game = generate_cite_ref(GAME_CITE_REF, GAME_SCHEMA_VERSION, title=u'Zelda', platform=u'NES')
+        self.perf = generate_cite_ref(PERF_CITE_REF, PERF_SCHEMA_VERSION, title=u'Zelda run',
+                                      game_uuid=self.game['uuid'])
+        for cite in (self.game, self.perf):
+            self.dbm.add_to_citation_table(cite, fts=True)
+        self.dbm.flush_fts()
+        self.partial = {'start_index': 0, 'description': {'title': u'zelda'}}
+
+    def test_search_records(self):
+        results, results_dict = search_records(self.partial)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results_dict['games'][0]['uuid'], self.game['uuid'])
+        self.assertEqual(results_dict['performances'][0]['game']['uuid'], self.game['uuid'])
+        results, results_dict = search_records(self.partial, search_type=PERF_CITE_REF)
+        self.assertEqual([r['uuid'] for r in results], [self.perf['uuid']])
+
+    def test_search_display(self):
+        results_dict = search_display(self.partial, search_type=GAME_CITE_REF)
+        self.assertEqual(results_dict['games'], [dict(uuid=self.game['uuid'], title=u'Zelda', platform=u'NES',
+                                                      ref_type=GAME_CITE_REF)])
+        self.assertEqual(results_dict['total_records'], 1)
+        self.assertEqual(search_display(self.partial)['total_performance_records'], 1)
+
+    def test_exclude_ref_types(self):
+        self.assertEqual(get_exclude_ref_types(), ('extracted',))
+        self.assertNotIn(STATE_CITE_REF, get_exclude_ref_types(STATE_CITE_REF))
+        self.assertEqual(get_exclude_ref_types('unknown'), get_exclude_ref_types('all'))
+
@@ -1,7 +1,7 @@
 __author__ = 'erickaltman'
 
 import unittest
-from utils import clean_for_sqlite_query
+from utils import clean_for_sqlite_query, LRUCache
 
 class TestUtilMethods(unittest.TestCase):
 
@@ -13,4 +13,25 @@ class TestUtilMethods(unittest.TestCase):
 
     def test_clean_for_sqlite(self):
         t = ":,::,,:"
-        self.assertEqual("", clean_for_sqlite_query(t))
\ No newline at end of file
+        self.assertEqual("", clean_for_sqlite_query(t))
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_size=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)                       # evicts 'b', the least recently used
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        cache.invalidate('c')
+        self.assertEqual(cache.get('c'), None)
+        self.assertEqual(cache.stats(), {'size': 1, 'max_size': 2, 'hits': 2, 'misses': 2})
+
+    def test_lru_cache_stale_put(self):
+        cache = LRUCache()
+        version = cache.version()
+        cache.invalidate('a')                   # e.g. an update after 'a' was read
+        self.assertFalse(cache.put('a', 'old', version=version))
+        self.assertEqual(cache.get('a'), None)
+        self.assertTrue(cache.put('a', 'new', version=cache.version()))
+        self.assertEqual(cache.get('a'), 'new')
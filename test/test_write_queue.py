@@ -0,0 +1,71 @@
+__author__ = 'erickaltman'
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import OperationalError
+from database import DatabaseManager
+from write_queue import WriteQueue, WriteFuture, WriteQueueError
+
+
+class TestWriteQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.engine = create_engine('sqlite:///{}'.format(os.path.join(self.temp_dir, 'writer.db')))
+        self.engine.execute('create table test_table (id integer primary key, name text)')
+        self.writer = WriteQueue(sessionmaker(bind=self.engine), DatabaseManager.execute_on_session, max_wait=0.05)
+
+    def count_rows(self):
+        return self.engine.execute('select count(*) from test_table').scalar()
+
+    def test_group_commit(self):
+        futures = [self.writer.submit('insert into test_table (name) values (:name)', {'name': str(i)})
+                   for i in range(50)]
+        for f in futures:
+            self.assertEqual(f.result(timeout=5), [])
+        self.assertEqual(self.count_rows(), 50)
+        self.assertTrue(self.writer.commits < 50)
+
+    def test_failed_write_is_isolated(self):
+        good = self.writer.submit('insert into test_table (name) values (:name)', {'name': 'good'})
+        bad = self.writer.submit('insert into not_a_table (name) values (:name)', {'name': 'bad'})
+        many = self.writer.submit('insert into test_table (name) values (?)', (('m{}'.format(i),) for i in range(3)),
+                                  many=True)
+        self.assertEqual(good.result(timeout=5), [])
+        self.assertRaises(OperationalError, bad.result, 5)
+        self.assertEqual(many.result(timeout=5), 3)
+        self.assertEqual(self.count_rows(), 4)
+        #   The replayed writes commit one at a time
+        stats = self.writer.stats()
+        self.assertEqual((stats['commits'], stats['writes'], stats['failures']), (2, 3, 1))
+
+    def test_dead_writer_fails_pending_writes(self):
+        class WriterKilled(BaseException):
+            pass
+
+        def execute(session, query, parameters, many):
+            raise WriterKilled('killed')
+        self.writer.stop()
+        self.writer = WriteQueue(sessionmaker(bind=self.engine), execute)
+        future = self.writer.submit('insert into test_table (name) values (:name)', {'name': 'lost'})
+        self.assertRaises(WriteQueueError, future.result, 5)
+        self.writer.thread.join(5)
+        self.assertRaises(WriteQueueError, self.writer.submit('select 1').result, 0)
+        self.assertTrue(issubclass(WriteQueueError, Exception))
+
+    def test_future_wait(self):
+        future = WriteFuture()
+        future.set_result(5)
+        self.assertTrue(future.done())
+        self.assertEqual(DatabaseManager.wait(future), 5)
+        self.assertEqual(DatabaseManager.wait([]), [])
+
+    def tearDown(self):
+        self.writer.stop()
+        self.engine.dispose()
+        shutil.rmtree(self.temp_dir)